@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Optional
+
+from providers.base import ProviderBase
+
+
+PROVIDERS = ('apod', 'bing')
+
+def get_provider(name: str) -> ProviderBase:
+	# Imported lazily, so a command only pays for the providers it uses
+	if name == 'apod':
+		from providers.apod import ApodProvider
+		return ApodProvider()
+	elif name == 'bing':
+		from providers.bing import BingProvider
+		return BingProvider()
+	raise ValueError(f'Unknown provider: {name}')
+
+def load_provider(name: str) -> Optional[ProviderBase]:
+	"""The provider with its catalog loaded, None if it has none yet."""
+	p = get_provider(name)
+	if not p.DATA_FILE.is_file():
+		print(f'NO CATALOG\t{name}')
+		return None
+	p.load()
+	return p
+
+
+##### COMMANDS #####
+
+def cmd_scan(args):
+	for name in args.providers:
+		p = load_provider(name)
+		if not p:
+			continue
+		report = p.scan_cache(verify=args.verify, update=not args.dry_run, n_jobs=args.jobs)
+
+		for img in report.missing:
+			print(f'MISSING\t{img.f_name}')
+		for img, error in report.corrupt:
+			print(f'CORRUPT\t{img.f_name}\t{error}')
+		for f_path in report.orphaned:
+			print(f'ORPHAN\t{f_path}')
+		print(report.summary())
+
+
+def cmd_quota(args):
+	from providers.quota import QuotaManager, format_size, parse_size
+
+	providers = [p for p in map(load_provider, args.providers) if p]
+
+	# The configured quotas, unless given
+	manager = QuotaManager.configured(providers)
+	for limit in args.limit:
+		name, _, size = limit.partition('=')
+		manager.per_provider[name] = parse_size(size)
+	if args.total:
+		manager.total = parse_size(args.total)
+
+	usage = manager.usage()
+	for p in providers:
+		quota = manager.quota(p)
+		quota_str = format_size(quota) if quota is not None else '-'
+		print(f'{p.SHORT_NAME}\t{format_size(usage[p.SHORT_NAME])}\t/ {quota_str}')
+
+	for p, img in manager.enforce(dry_run=args.dry_run):
+		print(f'EVICT\t{p.SHORT_NAME}\t{img.f_name}')
+
+
+def cmd_pin(args):
+	p = load_provider(args.provider)
+	if not p:
+		raise SystemExit(1)
+	f_names = set(args.f_names)
+	for img in p:
+		if img.f_name in f_names:
+			img.pinned = not args.unpin
+			f_names.remove(img.f_name)
+	for f_name in f_names:
+		print(f'NOT FOUND\t{f_name}')
+	p.dump()
+
+
+def cmd_search(args):
+	from peewee import OperationalError
+	from providers.search import search
+
+	if args.reindex:
+		for name in args.provider or PROVIDERS:
+			p = load_provider(name)
+			if p:
+				p.index_search()
+
+	if args.query:
+		query = ' '.join(args.query)
+		try:
+			results = search(query, args.limit, args.provider)
+		except OperationalError as e:
+			raise SystemExit(f'Invalid query {query!r}: {e}')
+		for r in results:
+			print(f'{r.score:.2f}\t{r.provider}\t{r.key}\t{r.title}')
+
+
+def cmd_compact(args):
+	from providers.compact import CompactSettings
+
+	settings = CompactSettings(args.format, args.quality, args.max_dim or None)
+	for name in args.providers:
+		p = load_provider(name)
+		if not p:
+			continue
+		if args.fetch_original:
+			for img in p:
+				if img.compact and img.f_name in args.fetch_original:
+					p.fetch_original(img)
+			p.dump()
+			continue
+		report = p.compact_images(settings=settings, keep_originals=args.keep_originals, n_jobs=args.jobs)
+		print(report.format(details=args.details))
+
+
+def parse_color(color: str) -> tuple[int, int, int]:
+	color = color.lstrip('#')
+	if len(color) != 6:
+		raise ValueError(f'Invalid color: {color!r}, use RRGGBB')
+	return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))	# type: ignore
+
+def cmd_colors(args):
+	from providers.features import FeatureStore
+
+	store = FeatureStore.load()
+	if args.extract:
+		for name in args.provider or PROVIDERS:
+			p = load_provider(name)
+			if p:
+				store.extract(p, n_jobs=args.jobs)
+		store.save()
+
+	landscape = {'landscape': True, 'portrait': False}.get(args.orientation)
+	color = parse_color(args.near) if args.near else None
+	matches = store.query(
+		n = args.limit,
+		order = 'distance' if color and not (args.dark or args.bright) else 'luminance',
+		reverse = args.bright,
+		color = color,
+		max_distance = args.max_distance,
+		landscape = landscape,
+		providers = args.provider,
+	)
+	for m in matches:
+		print(f'{m.luminance:.3f}\t{m.distance:.1f}\t{m.provider}\t{m.f_name}')
+
+
+def cmd_raw(args):
+	from providers.quota import format_size
+
+	for name in args.providers:
+		p = get_provider(name)
+		if args.import_legacy and hasattr(p, 'import_legacy_raw'):
+			p.import_legacy_raw()
+		for s in p.raw.snapshots():
+			print(f'{s.fetched.isoformat()}\t{p.SHORT_NAME}\t{s.name}\t{s.hash[:12]}\t{format_size(s.size)}')
+		stored, distinct = p.raw.disk_usage()
+		print(f'{p.SHORT_NAME}: {len(p.raw.snapshots())} snapshots, '
+			f'{format_size(distinct)} stored in {format_size(stored)}')
+
+
+def cmd_stress(args):
+	from providers.stress import run_stress
+
+	report = run_stress(args.images, args.batch, args.producers, args.jobs, args.keep)
+	print(report.summary())
+	if report.errors:
+		raise SystemExit(1)
+
+
+def cmd_scaling(args):
+	from providers.scaling import HISTORY_FILE, format_report, load_history, run_scaling
+
+	history_file = args.history or HISTORY_FILE
+	if not args.report_only:
+		run_scaling(tuple(args.sizes), args.stage, args.repeat, history_file, args.budget)
+	report, n_flags = format_report(load_history(history_file), args.last)
+	print(report)
+	if n_flags:
+		raise SystemExit(1)
+
+
+def cmd_scheduler(args):
+	from contextlib import redirect_stdout
+	from os import devnull
+	from providers.stress import compare_policies
+
+	# Quiet, the download logs would bury the table
+	with open(devnull, 'w') as f, redirect_stdout(f):
+		results = compare_policies(args.images, args.jobs, args.latency / 1000)
+
+	fmt = lambda t: f'{t:.2f}s' if t is not None else '-'
+	print('policy\tfirst done\trequested\tnewest\ttotal')
+	for r in results:
+		requested = min(r.stats.prioritized_waits, default=None)
+		print(f'{r.policy}\t{fmt(r.stats.first_done)}\t{fmt(requested)}\t'
+			f'{fmt(r.stats.newest_done)}\t{fmt(r.elapsed)}')
+
+
+def add_providers_arg(cmd):
+	cmd.add_argument('providers', nargs='*', metavar='provider',
+		help=f"any of {', '.join(PROVIDERS)} (default: all)")
+
+def main(argv=None):
+	parser = ArgumentParser(prog='wpd')
+	parser.add_argument('--transport', choices=['passthrough', 'record', 'replay'], default='passthrough',
+		help='record upstream responses, or replay them without any network access')
+	parser.add_argument('--transport-dir', type=Path, help='where responses are recorded')
+	sub = parser.add_subparsers(dest='command', required=True)
+
+	cmd = sub.add_parser('scan', help='scan, verify and import the image cache')
+	add_providers_arg(cmd)
+	cmd.add_argument('--verify', action='store_true', help='hash and decode every file')
+	cmd.add_argument('--dry-run', action='store_true', help="report only, don't touch the catalog")
+	cmd.add_argument('-j', '--jobs', type=int, default=8)
+	cmd.set_defaults(func=cmd_scan)
+
+	cmd = sub.add_parser('quota', help='evict least recently used images over the quota')
+	add_providers_arg(cmd)
+	cmd.add_argument('--total', help='quota for all the providers together, eg: 50G (default: from cache/quota.yaml)')
+	cmd.add_argument('--limit', action='append', default=[], metavar='PROVIDER=SIZE',
+		help='quota for a single provider, eg: bing=10G (default: from cache/quota.yaml)')
+	cmd.add_argument('--dry-run', action='store_true', help='only list what would be evicted')
+	cmd.set_defaults(func=cmd_quota)
+
+	cmd = sub.add_parser('pin', help='exempt images from eviction')
+	cmd.add_argument('provider', choices=PROVIDERS)
+	cmd.add_argument('f_names', nargs='+', metavar='f_name')
+	cmd.add_argument('--unpin', action='store_true')
+	cmd.set_defaults(func=cmd_pin)
+
+	cmd = sub.add_parser('compact', help='re-encode cached images to save space')
+	add_providers_arg(cmd)
+	cmd.add_argument('--format', choices=['WEBP', 'JPEG'], default='WEBP')
+	cmd.add_argument('--quality', type=int, default=85)
+	cmd.add_argument('--max-dim', type=int, default=3840, help='longest side, 0 to keep it')
+	cmd.add_argument('--keep-originals', action='store_true')
+	cmd.add_argument('--details', action='store_true', help='report every image')
+	cmd.add_argument('--fetch-original', action='append', metavar='F_NAME',
+		help='download the original of a compacted image again, instead of compacting')
+	cmd.add_argument('-j', '--jobs', type=int, default=None)
+	cmd.set_defaults(func=cmd_compact)
+
+	cmd = sub.add_parser('colors', help='select images by luminance and dominant color')
+	cmd.add_argument('--extract', action='store_true', help='extract the missing features first')
+	cmd.add_argument('-n', '--limit', type=int, default=20)
+	order = cmd.add_mutually_exclusive_group()
+	order.add_argument('--dark', action='store_true', help='darkest first (default)')
+	order.add_argument('--bright', action='store_true', help='brightest first')
+	cmd.add_argument('--near', metavar='RRGGBB', help='dominant color close to this one')
+	cmd.add_argument('--max-distance', type=float, help='RGB distance to --near, 0 to 441')
+	cmd.add_argument('--orientation', choices=['landscape', 'portrait'])
+	cmd.add_argument('-p', '--provider', action='append', choices=PROVIDERS)
+	cmd.add_argument('-j', '--jobs', type=int, default=8)
+	cmd.set_defaults(func=cmd_colors)
+
+	cmd = sub.add_parser('search', help='full text search on titles, credits and descriptions')
+	cmd.add_argument('query', nargs='*', help='FTS5 query, eg: nebula OR iceland')
+	cmd.add_argument('-n', '--limit', type=int, default=20)
+	cmd.add_argument('-p', '--provider', action='append', choices=PROVIDERS)
+	cmd.add_argument('--reindex', action='store_true', help='index all the catalogs again')
+	cmd.set_defaults(func=cmd_search)
+
+	cmd = sub.add_parser('raw', help='list the archived upstream responses')
+	add_providers_arg(cmd)
+	cmd.add_argument('--import-legacy', action='store_true', help='archive the bing_*.json files of older versions')
+	cmd.set_defaults(func=cmd_raw)
+
+	cmd = sub.add_parser('stress', help='parse, download and dump a synthetic catalog concurrently, then check it')
+	cmd.add_argument('-n', '--images', type=int, default=2000)
+	cmd.add_argument('--batch', type=int, default=50, help='entries added per update')
+	cmd.add_argument('--producers', type=int, default=2, help='threads adding entries')
+	cmd.add_argument('-j', '--jobs', type=int, default=8)
+	cmd.add_argument('--keep', action='store_true', help="don't remove the files afterwards")
+	cmd.set_defaults(func=cmd_stress)
+
+	cmd = sub.add_parser('scheduler', help='compare the download scheduler policies on a synthetic catalog')
+	cmd.add_argument('-n', '--images', type=int, default=500)
+	cmd.add_argument('-j', '--jobs', type=int, default=4)
+	cmd.add_argument('--latency', type=float, default=20, help='per download, in ms')
+	cmd.set_defaults(func=cmd_scheduler)
+
+	cmd = sub.add_parser('scaling', help='time stages on growing synthetic catalogs and flag superlinear growth')
+	cmd.add_argument('-s', '--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+	cmd.add_argument('--stage', action='append', choices=['download_images_async', 'process_pages', 'load'])
+	cmd.add_argument('-r', '--repeat', type=int, default=1, help='keep the best of this many runs')
+	cmd.add_argument('--budget', type=float, default=120, help='seconds a stage may take on a single size')
+	cmd.add_argument('--history', type=Path, help='history file (default: cache/scaling_history.yaml)')
+	cmd.add_argument('--last', type=int, default=5, help='runs to compare')
+	cmd.add_argument('--report-only', action='store_true', help="don't run, only compare the history")
+	cmd.set_defaults(func=cmd_scaling)
+
+	args = parser.parse_args(argv)
+	if args.transport != 'passthrough' or args.transport_dir:
+		from providers.transport import STORE_DIR, Transport, set_transport
+		set_transport(Transport(args.transport, args.transport_dir or STORE_DIR))
+	if 'providers' in args:
+		args.providers = args.providers or list(PROVIDERS)
+		for name in args.providers:
+			if name not in PROVIDERS:
+				parser.error(f'unknown provider: {name}')
+
+	from providers.transport import ReplayMiss, get_transport
+	transport = get_transport()
+	try:
+		args.func(args)
+	except ReplayMiss as e:
+		print(f'Stopped: {e}')
+	if transport.mode == 'replay' and transport.misses:
+		raise SystemExit(f'{transport.misses} requests not recorded')
+
+
+if __name__ == "__main__":
+	main()
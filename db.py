@@ -4,6 +4,7 @@ from __future__ import annotations
 from os import stat
 
 from peewee import CharField, DateField, IntegerField, Model, SqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 
 db = SqliteDatabase('cache/wpd.db')
 
@@ -19,4 +20,27 @@ class ApodStatus(BaseModel):
 	status = CharField(choices=['UNPROCESSED', 'OK', 'VERTICAL', 'OLD', 'IFRAME', 'OBJECT', 'EMBED', 'APPLET', 'ERROR'])
 	status_int = IntegerField(choices=[0, 1, 2, 3, 10, 11, 12, 13, 100])
 
+
+class ImageKey(BaseModel):
+	# Stable rowid for each image on ImageSearch, so it can be replaced
+	provider = CharField()
+	key = CharField()
+
+	class Meta:
+		indexes = ((('provider', 'key'), True),)
+
+
+class ImageSearch(FTS5Model):
+	rowid = RowIDField()	# ImageKey.id
+	provider = SearchField(unindexed=True)
+	key = SearchField(unindexed=True)
+	title = SearchField()
+	credit = SearchField()
+	explanation = SearchField()
+	copyright = SearchField()
+
+	class Meta:
+		database = db
+		options = {'tokenize': 'porter unicode61'}
+
 assert db.connect()
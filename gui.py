@@ -12,7 +12,7 @@ from widgets.main_win import MainWindow
 # default font-size: 10pt;
 app_css = b'* {font-size: 12pt;}'
 
-def main(threaded=True):
+def main():
 	main_win = MainWindow()
 	main_win.show_all()
 
@@ -24,13 +24,9 @@ def main(threaded=True):
 		Gtk.STYLE_PROVIDER_PRIORITY_USER
 	)
 
-	
-	if not threaded:
-		Gtk.main()
-	else:
-		from threading import Thread
-		t = Thread(name='GTK Thread', target=Gtk.main)
-		t.start()
+	# GTK must own the main thread, the slow work runs on workers that
+	# hand their results back through GLib.idle_add.
+	Gtk.main()
 
 
 if __name__ == "__main__":
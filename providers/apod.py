@@ -3,17 +3,20 @@
 from __future__ import annotations
 from dataclasses import dataclass, field
 from datetime import datetime, date as Date
-from typing import Union
+from typing import Optional, Union
 from pathlib import Path
+from threading import Event
 from urllib.parse import parse_qsl
+from hashlib import sha256
+import re
 import yaml
 
-import requests
 import lxml.html
 from lxml.html import HtmlElement
 from singleton_decorator import singleton
 
 from .base import ImageBase, ProviderBase, StatusEnum, CACHE_DIR, log
+from .transport import ReplayMiss
 
 
 ##### HELPERS #####
@@ -71,6 +74,9 @@ class ApodImage(ImageBase):
 	url_path: str
 	page_name: str
 	repeated: list[ApodImage] = None	# type: ignore
+	title: Optional[str] = None
+	credit: Optional[str] = None
+	about: Optional[str] = None		# explanation
 
 
 ##### PROVIDER CLASS #####
@@ -81,10 +87,13 @@ class ApodProvider(ProviderBase):
 
 	DATA_DIR = CACHE_DIR / SHORT_NAME
 	IMG_DIR = DATA_DIR / 'imgs'
+	COMPACT_DIR = DATA_DIR / 'compact'
+	RAW_DIR = DATA_DIR / 'raw'
 	PAGE_DIR = DATA_DIR / 'pages'
 	DATA_FILE = DATA_DIR / f'{SHORT_NAME}.yaml'
 	STATUS_FILE = DATA_DIR / 'STATUS.yaml'
 	GROUPS_FILE = DATA_DIR / 'STATUS_GROUPS.yaml'
+	PAGES_INDEX_FILE = DATA_DIR / 'PAGES_INDEX.yaml'
 
 	URL_BASE = "https://apod.nasa.gov/apod/"
 	DATE_F_NAME_BASE = 'ap%y%m%d.html'
@@ -94,10 +103,19 @@ class ApodProvider(ProviderBase):
 	DATE_FMT = "%y%m%d"
 	DATETIME_FMT = "%y%m%d_%H%M%S"
 
-	pages: list[str] = []
-	page_status: dict[str, ApodStatus] = {}
-	groups: dict[str, list[str]] = {}
-	_url_paths: dict[str, Union[ApodImage, list[ApodImage]]] = {}
+	pages: list[str]
+	page_status: dict[str, ApodStatus]
+	groups: dict[str, list[str]]
+	_url_paths: dict[str, Union[ApodImage, list[ApodImage]]]
+
+	def __init__(self, initlist=None):
+		super().__init__(initlist)
+		# All guarded by self.lock, as data
+		self.data_dict: dict[str, ApodImage] = {}
+		self.pages = []
+		self.page_status = {}
+		self.groups = {name:[] for name in ApodStatus.__members__}
+		self._url_paths = {}
 
 
 	@classmethod
@@ -109,20 +127,15 @@ class ApodProvider(ProviderBase):
 		return datetime.strptime(page_name, cls.DATE_F_NAME_BASE).date()
 
 
-	def download_page(self, f_name:str):
+	def download_page(self, f_name:str) -> bytes:
 		log(f"{self.__class__.__name__}: Downloading page ({f_name=})")
-	
-		url = self.URL_BASE + f_name
-		res = requests.get(url)
-		assert res.status_code == 200
-		res.bytes = res.content		# type: ignore
-		return res
+		return self._fetch(self.URL_BASE + f_name)
 
 	def get_page(self, f_name: str, cache=True) -> str:
 		# log(f"{self.__class__.__name__}: Getting page ({f_name=})")
 
 		if not cache:
-			return self.download_page(f_name).text
+			return self.download_page(f_name).decode(errors='replace')
 
 		if cache is True:
 			cache = self.PAGE_DIR
@@ -132,7 +145,7 @@ class ApodProvider(ProviderBase):
 			return (cache / f_name).read_text(errors='replace')
 
 		# Cache miss
-		page_bytes: bytes = self.download_page(f_name).bytes	# type: ignore
+		page_bytes = self.download_page(f_name)
 
 		f_path = cache / f_name
 		log(f"{self.__class__.__name__}: \tSaving archive (file={f_path})")
@@ -154,7 +167,71 @@ class ApodProvider(ProviderBase):
 		return self.parse_archive_page(page)
 
 	def get_pages_list(self, cache=True, full:bool=False) -> list[str]:
-		return self.get_archive_info(full, cache)
+		"""Pages on the archive, newest first.
+
+		Without `cache`, the archive is downloaded again and replaces the
+		cached one. The parsed list is kept on PAGES_INDEX_FILE along with
+		the archive size, mtime and hash, so it's only parsed again when
+		the archive changes, and then only the new entries on its head.
+		"""
+		f_name = self.FULL_ARCHIVE_F_NAME if full else self.ARCHIVE_F_NAME
+		f_path = self.PAGE_DIR / f_name
+
+		if not cache or not f_path.is_file():
+			page_bytes = self.download_page(f_name)
+			self.raw.put(f_name, page_bytes)
+			if not f_path.is_file() or f_path.read_bytes() != page_bytes:
+				log(f"{self.__class__.__name__}: \tSaving archive (file={f_path})")
+				f_path.write_bytes(page_bytes)
+
+		index = self._load_pages_index()
+		entry = index.get(f_name)
+		st = f_path.stat()
+		if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+			return entry['pages'].split()
+
+		page_bytes = f_path.read_bytes()
+		digest = sha256(page_bytes).hexdigest()
+		old_pages = entry['pages'].split() if entry else []
+		if entry and entry['hash'] == digest:
+			pages = old_pages
+		else:
+			page = page_bytes.decode(errors='replace')
+			pages = self.merge_archive_head(page, old_pages)
+			if pages:
+				log(f"{self.__class__.__name__}: \tMerged {len(pages) - len(old_pages)} new pages ({f_name=})")
+			else:
+				log(f"{self.__class__.__name__}: \tParsing archive ({f_name=})")
+				pages = self.parse_archive_page(page)
+
+		index[f_name] = {
+			'size': st.st_size,
+			'mtime': st.st_mtime_ns,
+			'hash': digest,
+			# A single scalar loads much faster than a list of 10k of them
+			'pages': ' '.join(pages),
+		}
+		self._dump_pages_index(index)
+		return pages
+
+	def pages_at(self, when: datetime, full: bool = False) -> Optional[list[str]]:
+		"""Pages on the archive as it was at `when`, from the raw archive."""
+		f_name = self.FULL_ARCHIVE_F_NAME if full else self.ARCHIVE_F_NAME
+		snapshot = self.raw.at(f_name, when)
+		if not snapshot:
+			return None
+		return self.parse_archive_page(self.raw.read(snapshot).decode(errors='replace'))
+
+	def _load_pages_index(self) -> dict[str, dict]:
+		if not self.PAGES_INDEX_FILE.is_file():
+			return {}
+		loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+		return yaml.load(self.PAGES_INDEX_FILE.open(), Loader=loader) or {}
+
+	def _dump_pages_index(self, index: dict[str, dict]):
+		log(f"{self.__class__.__name__}: Dumping pages index (file={self.PAGES_INDEX_FILE})")
+		dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+		yaml.dump(index, self.PAGES_INDEX_FILE.open('w'), Dumper=dumper)
 
 	@staticmethod
 	def parse_archive_page(page: str) -> list[str]:
@@ -163,7 +240,26 @@ class ApodProvider(ProviderBase):
 		pages = list(map(str, entries))
 		return pages
 
-	### TODO: FINISH
+	_archive_entry_pattern = re.compile(r'<a\s+href\s*=\s*["\']?(ap\d{6}\.html)', re.I)
+
+	@classmethod
+	def merge_archive_head(cls, page: str, pages: list[str]) -> Optional[list[str]]:
+		"""Prepend to `pages` the entries of the archive `page` newer than it.
+
+		The archive is newest first, so only its head is scanned, until the
+		first entry already known. Returns None if that isn't found, then
+		the whole page needs to be parsed.
+		"""
+		if not pages:
+			return None
+		head = []
+		for m in cls._archive_entry_pattern.finditer(page):
+			page_name = m.group(1)
+			if page_name == pages[0]:
+				return head + pages
+			head.append(page_name)
+		return None
+
 	def parse_day_page(self, page: str, f_name:str) -> tuple[ApodStatus, dict]:
 		dom = get_dom(page)
 
@@ -186,22 +282,7 @@ class ApodProvider(ProviderBase):
 		if image_href in self._url_paths:
 			return ApodStatus.REPEATED, {}	# type: ignore
 
-		# try:
-		# 	title = dom.xp_one('/html/body/center[2]/b[1]/text()').strip()
-		# except AssertionError:
-		# 	title = dom.xp_one('/html/body/center[2]/i/b[1]/text()').strip()
-		title = None
-
-		# block = dom.xp_one('/html/body/center[2]').text_content().strip().split('\n')
-		# assert block.pop(0).strip() == title
-		# credit_header = dom.xp_one('/html/body/center[2]/b[2]/text()').strip()
-		# credit = ' '.join(block).strip().removeprefix(credit_header).strip()
-		credit = None
-
-		# expl_header = dom.xp_one('/html/body/p[1]/b/text()').strip()
-		# explanation = dom.xp_one('/html/body/p[1]').text_content().strip()
-		# explanation = explanation.removeprefix(expl_header).strip()
-		explanation = None
+		title, credit, explanation = self.parse_day_meta(dom)
 
 		return ApodStatus.OK, {
 			'url': image_href,
@@ -210,6 +291,38 @@ class ApodProvider(ProviderBase):
 			'about': explanation,
 		}
 
+	@staticmethod
+	def parse_day_meta(dom: HtmlElement) -> tuple[Optional[str], Optional[str], Optional[str]]:
+		"""Title, credit and explanation of a day page, None when not found."""
+		def clean(text: str) -> str:
+			return ' '.join(text.split())
+
+		title = credit = explanation = None
+
+		# The title is the first bold text on the second center block, the
+		# rest of that block, after a "Credit" header, is the credit.
+		centers = dom.xpath('/html/body/center[2]')
+		if centers:
+			title_nodes = centers[0].xpath('(.//b)[1]')
+			if title_nodes:
+				title = clean(title_nodes[0].text_content()) or None
+			block = clean(centers[0].text_content())
+			if title:
+				block = block.removeprefix(title).strip()
+			header = centers[0].xpath('(.//b[contains(., "redit")])[1]')
+			if header:
+				_, found, rest = block.partition(clean(header[0].text_content()))
+				block = rest if found else block
+			credit = block.strip() or None
+
+		expl_header = dom.xpath('(/html/body//b[contains(., "Explanation")])[1]')
+		if expl_header:
+			text = clean(expl_header[0].getparent().text_content())
+			_, _, explanation = text.partition(clean(expl_header[0].text_content()))
+			explanation = explanation.strip() or None
+
+		return title, credit, explanation
+
 	@staticmethod
 	def _should_skip_page(dom: HtmlElement) -> Union[bool, ApodStatus]:
 		# Old page format, we don't proccess them because the
@@ -240,78 +353,166 @@ class ApodProvider(ProviderBase):
 			url_path = info['url'],
 			url = self.URL_BASE + info['url'],
 			f_name= Path(info['url']).name,
-			# title = info['title'],
-			# about = info['about'],
-			# credit = info['credit'],
+			title = info['title'],
+			about = info['about'],
+			credit = info['credit'],
 		)
 
-	def process_pages(self, pages:list[str]=None, reset=True, save=True):
-		if reset:
-			self.data = []
-			self.data_dict = {}
-			self.page_status = {}
-			self.groups = {name:[] for name in ApodStatus.__members__}
+	def _set_page_status(self, page_name: str, status: ApodStatus):
+		old = self.page_status.get(page_name)
+		if old is not None:
+			# Processed again, eg: by another thread at the same time
+			self.groups[old.name].remove(page_name)
+		self.page_status[page_name] = status
+		self.groups[status.name].append(page_name)
+
+	def process_pages(self,
+					pages: list[str] = None,
+					reset=True,
+					save=True,
+					on_progress = None,
+					cancel: Optional[Event] = None,
+	) -> list[ApodImage]:
+		"""Fetch and parse day pages, returning the new images.
+
+		`on_progress(done, total)` is called after every page, and setting
+		`cancel` stops before the next one, keeping the ones processed.
+		"""
+		with self.lock:
+			if reset:
+				self.data = []
+				self.data_dict = {}
+				self.page_status = {}
+				self.groups = {name:[] for name in ApodStatus.__members__}
+				self._url_paths = {}
+			else:
+				for name in ApodStatus.__members__:
+					self.groups.setdefault(name, [])
+		if reset and save:
+			# Or the images of the previous catalog would still be found
+			self.clear_search()
 
 		if not pages:
 			pages = self.pages
 
+		# Fetching and parsing run unlocked, only recording the results
+		# holds the lock, so downloads and dumps can go on meanwhile.
+		new: list[ApodImage] = []
 		print()
-		for page_name in pages:
+		for i, page_name in enumerate(pages):
+			if on_progress:
+				on_progress(i, len(pages))
+			if cancel and cancel.is_set():
+				log(f"{self.__class__.__name__}: Cancelled, {i} of {len(pages)} pages processed")
+				break
 			print(f'Processing {page_name}', end='\t')
 			try:
 				page = self.get_page(page_name)
+			except ReplayMiss:
+				# Not an upstream error, the page must be fetched again later
+				print('NOT_RECORDED')
+				raise
 			except:
-				self.page_status[page_name] = ApodStatus.ERROR_RETRIEVING
-				self.groups[ApodStatus.ERROR_RETRIEVING.name].append(page_name)
+				print('ERROR_RETRIEVING')
+				with self.lock:
+					self._set_page_status(page_name, ApodStatus.ERROR_RETRIEVING)
+				continue
 
 			try:
 				status, info_d = self.parse_day_page(page, page_name)	# type: ignore
-				print(status.name)
-				self.page_status[page_name] = status
-				self.groups[status.name].append(page_name)
 			except:
 				print('ERROR')
-				self.page_status[page_name] = ApodStatus.ERROR
-				self.groups[ApodStatus.ERROR.name].append(page_name)
+				with self.lock:
+					self._set_page_status(page_name, ApodStatus.ERROR)
 				continue
 
-			if not save: continue
-			if status != ApodStatus.OK: continue
-
-			img = self.process_image_info(info_d, page_name)
-			self.data_dict[page_name] = img
-			self.data.append(img)
-			self._url_paths[img.url_path] = img
+			img = None
+			if save and status == ApodStatus.OK:
+				img = self.process_image_info(info_d, page_name)
+
+			with self.lock:
+				if page_name in self.data_dict:
+					# Another thread got the image of this same page meanwhile
+					print('DONE')
+					continue
+				# Checked again, another thread may have added it meanwhile
+				if img and img.url_path in self._url_paths:
+					status, img = ApodStatus.REPEATED, None
+				print(status.name)
+				self._set_page_status(page_name, status)
+				if img:
+					self.data_dict[page_name] = img
+					self.data.append(img)
+					self._url_paths[img.url_path] = img
+					new.append(img)
+		else:
+			if on_progress:
+				on_progress(len(pages), len(pages))
 		print()
 
+		if save:
+			self.index_search(new)
+		return new
+
+	def search_fields(self, img: ApodImage) -> dict[str, Optional[str]]:
+		return {
+			'title': img.title,
+			'credit': img.credit,
+			'explanation': img.about,
+		}
+
 	def classify_pages(self, pages: list[str] = None):
 		self.process_pages(pages, save=False)
 
+	def update(self, on_progress=None, cancel: Optional[Event] = None) -> list[ApodImage]:
+		known = set(self.page_status)
+		self.load_pages(cache=False)
+		new_pages = [page_name for page_name in self.pages if page_name not in known]
+		if not new_pages:
+			return []
+		return self.process_pages(new_pages, reset=False, on_progress=on_progress, cancel=cancel)
+
 
 	def dump(self):
-		super().dump()
-		log(f"{self.__class__.__name__}: Dumping status (file={self.STATUS_FILE})")
-		yaml.dump(self.page_status, self.STATUS_FILE.open('w'))
-		status_desc = {k:v.name for k, v in self.page_status.items()}
-		yaml.dump(status_desc, self.STATUS_FILE.with_stem('STATUS_DESC').open('w'))
-		log(f"{self.__class__.__name__}: Dumping groups (file={self.GROUPS_FILE})")
-		yaml.dump(self.groups, self.GROUPS_FILE.open('w'))
+		# The data, status and groups are taken at once, and written
+		# before any other dump, so the three files always agree
+		with self._dump_lock:
+			with self.lock:
+				data = self.snapshot()
+				page_status = dict(self.page_status)
+				groups = {name: list(pages) for name, pages in self.groups.items()}
+			log(f"{self.__class__.__name__}: Dumping data (file={self.DATA_FILE})")
+			self._dump_yaml(data, self.DATA_FILE)
+			log(f"{self.__class__.__name__}: Dumping status (file={self.STATUS_FILE})")
+			self._dump_yaml(page_status, self.STATUS_FILE)
+			status_desc = {k:v.name for k, v in page_status.items()}
+			self._dump_yaml(status_desc, self.STATUS_FILE.with_stem('STATUS_DESC'))
+			log(f"{self.__class__.__name__}: Dumping groups (file={self.GROUPS_FILE})")
+			self._dump_yaml(groups, self.GROUPS_FILE)
 
 	def load(self):
 		super().load()
-		self._build_url_paths
-		self.load_pages()
+		pages = self.get_pages_list(full=True)
 
 		log(f"{self.__class__.__name__}: Loading status (file={self.STATUS_FILE})")
-		self.page_status = yaml.unsafe_load(self.STATUS_FILE.open())
+		page_status = yaml.unsafe_load(self.STATUS_FILE.open())
 		log(f"{self.__class__.__name__}: Loading groups (file={self.GROUPS_FILE})")
-		self.groups = yaml.unsafe_load(self.GROUPS_FILE.open())
+		groups = yaml.unsafe_load(self.GROUPS_FILE.open())
+
+		with self.lock:
+			self.data_dict = {img.page_name: img for img in self.data}
+			self._build_url_paths()
+			self.pages = pages
+			self.page_status = page_status
+			self.groups = groups
 
 	def load_pages(self, cache=True, full=True):
-		self.pages = self.get_pages_list(cache=cache, full=full)
+		pages = self.get_pages_list(cache=cache, full=full)
+		with self.lock:
+			self.pages = pages
 
 	def _build_url_paths(self):
-		directory = self._url_paths
+		directory = self._url_paths = {}
 		for img in self:
 			p = img.url_path
 			if p not in directory:
@@ -341,6 +542,6 @@ class ApodProvider(ProviderBase):
 		db.commit()
 
 
-p = ApodProvider()
-p.load_pages()
-p.load()
+if __name__ == "__main__":
+	p = ApodProvider()
+	p.load()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import datetime
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+import lzma
+
+from .base import log
+
+
+@dataclass
+class Snapshot:
+	fetched: datetime	# first fetch with this content
+	name: str			# what was fetched, eg: the page name
+	hash: str			# sha256 of the raw bytes
+	size: int			# uncompressed
+
+
+class RawArchive:
+	"""Raw upstream responses, stored once per distinct content.
+
+	Objects are keyed by the sha256 of the response and kept under
+	`objects/`, xz compressed unless `compress=False` (eg: for images,
+	already compressed). `timeline.tsv` records, for every name, when its
+	content changed: fetching the same bytes again adds nothing, so the
+	disk use only grows with actual upstream changes. The snapshot of a
+	name at any time is the last change before it.
+	"""
+
+	EXTENSION = '.xz'
+	RAW_EXTENSION = '.bin'
+
+	def __init__(self, root: Path, compress: bool = True):
+		self.root = root
+		self.compress = compress
+		self.objects_dir = root / 'objects'
+		self.timeline_file = root / 'timeline.tsv'
+		self.lock = Lock()
+		self._timeline: Optional[dict[str, list[Snapshot]]] = None
+
+	def _object_path(self, digest: str, compressed: bool = True) -> Path:
+		extension = self.EXTENSION if compressed else self.RAW_EXTENSION
+		return self.objects_dir / digest[:2] / (digest[2:] + extension)
+
+	@property
+	def timeline(self) -> dict[str, list[Snapshot]]:
+		"""Snapshots by name, oldest first."""
+		if self._timeline is None:
+			timeline: dict[str, list[Snapshot]] = {}
+			if self.timeline_file.is_file():
+				for line in self.timeline_file.read_text().splitlines():
+					fetched, name, digest, size = line.split('\t')
+					snapshot = Snapshot(datetime.fromisoformat(fetched), name, digest, int(size))
+					timeline.setdefault(name, []).append(snapshot)
+			for snapshots in timeline.values():
+				snapshots.sort(key=lambda s: s.fetched)
+			self._timeline = timeline
+		return self._timeline
+
+
+	def put(self, name: str, data: bytes, fetched: Optional[datetime] = None, compress: Optional[bool] = None) -> Snapshot:
+		"""Store a response of `name`, returns its snapshot (maybe an older one)."""
+		compress = self.compress if compress is None else compress
+		fetched = fetched or datetime.now().replace(microsecond=0)
+		digest = sha256(data).hexdigest()
+		with self.lock:
+			snapshot = self.at(name, fetched)
+			if snapshot and snapshot.hash == digest:
+				return snapshot
+
+			if not self.has(digest):
+				f_path = self._object_path(digest, compress)
+				log(f"{type(self).__name__}: \tSaving snapshot (file={f_path})")
+				f_path.parent.mkdir(parents=True, exist_ok=True)
+				tmp = f_path.with_name(f_path.name + '.tmp')
+				tmp.write_bytes(lzma.compress(data) if compress else data)
+				tmp.replace(f_path)
+
+			snapshot = Snapshot(fetched, name, digest, len(data))
+			snapshots = self.timeline.setdefault(name, [])
+			snapshots.insert(bisect_right([s.fetched for s in snapshots], fetched), snapshot)
+			self.root.mkdir(parents=True, exist_ok=True)
+			with self.timeline_file.open('a') as f:
+				f.write(f'{fetched.isoformat()}\t{name}\t{digest}\t{len(data)}\n')
+			return snapshot
+
+	def has(self, digest: str) -> bool:
+		return self._object_path(digest).is_file() or self._object_path(digest, False).is_file()
+
+	def get(self, digest: str) -> bytes:
+		f_path = self._object_path(digest)
+		if f_path.is_file():
+			data = lzma.decompress(f_path.read_bytes())
+		else:
+			data = self._object_path(digest, False).read_bytes()
+		assert sha256(data).hexdigest() == digest, f'Corrupt snapshot: {digest}'
+		return data
+
+	def read(self, snapshot: Snapshot) -> bytes:
+		return self.get(snapshot.hash)
+
+
+	def snapshots(self, name: Optional[str] = None) -> list[Snapshot]:
+		"""Snapshots of `name`, or of everything, oldest first."""
+		if name is not None:
+			return list(self.timeline.get(name, []))
+		return sorted((s for ss in self.timeline.values() for s in ss), key=lambda s: s.fetched)
+
+	def latest(self, name: str) -> Optional[Snapshot]:
+		snapshots = self.timeline.get(name)
+		return snapshots[-1] if snapshots else None
+
+	def at(self, name: str, when: datetime) -> Optional[Snapshot]:
+		"""The snapshot of `name` that was current at `when`."""
+		snapshots = self.timeline.get(name, [])
+		i = bisect_right([s.fetched for s in snapshots], when)
+		return snapshots[i - 1] if i else None
+
+
+	def disk_usage(self) -> tuple[int, int]:
+		"""Compressed bytes on disk, and the sum of the distinct contents."""
+		stored = sum(
+			f.stat().st_size for f in self.objects_dir.glob('*/*')
+			if f.suffix in (self.EXTENSION, self.RAW_EXTENSION)
+		)
+		distinct = {s.hash: s.size for s in self.snapshots()}
+		return stored, sum(distinct.values())
+
+	def import_file(self, name: str, f_path: Path, fetched: datetime, remove: bool = False) -> Snapshot:
+		"""Archive a response saved as a plain file, eg: by older versions."""
+		data = f_path.read_bytes()
+		snapshot = self.put(name, data, fetched)
+		if remove:
+			assert self.read(snapshot) == data
+			f_path.unlink()
+		return snapshot
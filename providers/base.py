@@ -4,18 +4,24 @@ from __future__ import annotations
 from dataclasses import dataclass, field
 from pathlib import Path
 from collections import UserList
-from typing import Optional, Union
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from typing import Optional, Union, TYPE_CHECKING
 from datetime import datetime, date
 from enum import Enum
 from hashlib import sha256
 from PIL import Image
-from threading import Thread
+from threading import Event, Lock, RLock, Thread
 from queue import Queue
+import mmap
 import os
 import re
 import yaml
 
-import requests
+if TYPE_CHECKING:
+	from .archive import RawArchive
+	from .compact import CompactSettings
+	from .quota import QuotaManager
 
 
 Image.MAX_IMAGE_PIXELS = None	# type: ignore
@@ -54,12 +60,77 @@ class ImageBase:
 	resolution: Optional[tuple[int, int]] = field(init=False, default=None)
 	# w x h
 
+	# usage data
+	accessed: Optional[datetime] = field(init=False, default=None)
+	pinned: bool = field(init=False, default=False)	# never evicted
+
+	# Set when the stored file is a compact re-encode of the original (see
+	# providers.compact). The fields above keep describing the original.
+	compact: Optional[CompactInfo] = field(init=False, default=None)
+
 
 	@property
 	def file(self) -> Optional[Path]:
 		if not self.local: return None
 		return CACHE_DIR / self.local
 
+	@property
+	def stored_size(self) -> Optional[int]:
+		return self.compact.size if self.compact else self.size
+
+	@property
+	def stored_hash(self) -> Optional[str]:
+		return self.compact.hash if self.compact else self.hash
+
+
+@dataclass
+class CompactInfo:
+	size: int
+	hash: str
+	format: str
+	resolution: tuple[int, int]
+	quality: int
+
+
+def hash_file(f_path: Path) -> str:
+	# mmap avoids copying the whole file into a bytes object, and sha256
+	# releases the GIL while hashing it, so this scales over threads.
+	h = sha256()
+	with f_path.open('rb') as f:
+		if os.fstat(f.fileno()).st_size:
+			with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				h.update(m)
+	return h.hexdigest()
+
+
+##### CACHE SCAN #####
+
+@dataclass
+class FileInfo:
+	f_path: Path
+	size: int
+	hash: Optional[str] = None
+	format: Optional[str] = None
+	resolution: Optional[tuple[int, int]] = None
+	error: Optional[str] = None
+
+
+@dataclass
+class ScanReport:
+	provider: str
+	imported: list[ImageBase] = field(default_factory=list)	# new or changed local data
+	verified: list[ImageBase] = field(default_factory=list)	# hashed and matched
+	skipped: list[ImageBase] = field(default_factory=list)	# size and mtime matched
+	missing: list[ImageBase] = field(default_factory=list)	# in catalog, not on FS
+	corrupt: list[tuple[ImageBase, str]] = field(default_factory=list)
+	orphaned: list[Path] = field(default_factory=list)	# on FS, not in catalog
+
+	def summary(self) -> str:
+		return (f'{self.provider}: '
+			f'{len(self.imported)} imported, {len(self.verified)} verified, '
+			f'{len(self.skipped)} skipped, {len(self.missing)} missing, '
+			f'{len(self.corrupt)} corrupt, {len(self.orphaned)} orphaned')
+
 
 
 ##### PROVIDER CLASS #####
@@ -109,8 +180,12 @@ class ThreadWorkerPoll:
 		f = self.process_function
 		while self.running:
 			arg = self.queue.get()
-			f(arg)
-			self.queue.task_done()
+			try:
+				f(arg)
+			except Exception as e:
+				log(f'Thread worker {i}: {type(e).__name__}: {e} ({arg=})')
+			finally:
+				self.queue.task_done()
 
 
 
@@ -120,25 +195,146 @@ class ProviderBase(UserList):
 
 	DATA_DIR = CACHE_DIR / SHORT_NAME
 	IMG_DIR = DATA_DIR / 'imgs'
+	COMPACT_DIR = DATA_DIR / 'compact'
+	RAW_DIR = DATA_DIR / 'raw'
 	DATA_FILE = DATA_DIR / f'{SHORT_NAME}.yaml'
 
 	DATE_FMT = "%Y%m%d"
 	DATETIME_FMT = "%Y%m%d_%H%M%S"
 
+	QUOTA: Optional[int] = None		# bytes stored, None is unlimited
+	COMPACT: Optional[CompactSettings] = None	# re-encode downloaded images
+
 	data: list[ImageBase]
+	raw: RawArchive
+
+	def __init__(self, initlist=None):
+		super().__init__(initlist)
+		self.listeners = []
+		# Guards `data` and the fields of its images, so parsing, downloading
+		# and dumping can run on different threads. Slow work (network, FS,
+		# decoding) is done without it, only the state changes hold it.
+		self.lock = RLock()
+		self._dump_lock = RLock()	# held across the files of a dump
+
+		from .archive import RawArchive
+		self.raw = RawArchive(self.RAW_DIR)	# upstream responses, see providers.archive
+
+	def add_listener(self, listener):
+		"""Call `listener(provider, img)` when an image is added or its local data changes.
+
+		Listeners may be called from worker threads.
+		"""
+		self.listeners.append(listener)
+
+	def remove_listener(self, listener):
+		self.listeners.remove(listener)
 
+	def _notify(self, img: ImageBase):
+		for listener in self.listeners:
+			listener(self, img)
+
+
+	def snapshot(self) -> list[ImageBase]:
+		"""Copies of the entries, consistent as a whole, safe to read unlocked."""
+		with self.lock:
+			return [copy(img) for img in self.data]
 
 	def dump(self):
 		log(f"{self.__class__.__name__}: Dumping data (file={self.DATA_FILE})")
-		yaml.dump(self.data, self.DATA_FILE.open('w'))
+		self._dump_yaml(self.snapshot(), self.DATA_FILE)
+
+	def _dump_yaml(self, data, f_path: Path):
+		# Written aside and then renamed, so a reader never sees it half written
+		with self._dump_lock:
+			tmp = f_path.with_name(f_path.name + '.tmp')
+			with tmp.open('w') as f:
+				yaml.dump(data, f)
+			tmp.replace(f_path)
 
 	def load(self):
 		log(f"{self.__class__.__name__}: Loading data (file={self.DATA_FILE})")
-		self.data = yaml.unsafe_load(self.DATA_FILE.open())
+		data = yaml.unsafe_load(self.DATA_FILE.open())
+		with self.lock:
+			self.data = data
 
 	def download_info(self, save_raw=True):
 		raise NotImplementedError
 
+	def search_fields(self, img: ImageBase) -> dict[str, Optional[str]]:
+		"""Text of the image for the search index (see providers.search)."""
+		return {}
+
+	def index_search(self, images: Optional[list[ImageBase]] = None):
+		from .search import index_images
+		index_images(self, self.data if images is None else images)
+
+	def clear_search(self):
+		from .search import remove_images
+		remove_images(self)
+
+	def update(self, on_progress=None, cancel: Optional[Event] = None) -> list[ImageBase]:
+		"""Fetch the upstream catalog and add the new entries, returning them.
+
+		Takes `on_progress` and `cancel` as `sync` does, for providers
+		fetching a page per entry.
+		"""
+		raise NotImplementedError
+
+	def sync(self,
+			on_progress = None,
+			cancel: Optional[Event] = None,
+			auto_dump: bool = True,
+			n_jobs: int = 8,
+			quota: Optional[QuotaManager] = None,
+	) -> list[ImageBase]:
+		"""Update the catalog and download the images never downloaded before.
+
+		Blocks until done, it's meant to run on a background thread. The
+		downloads go through the shared scheduler (providers.scheduler).
+		`on_progress(done, total)` is called from the worker threads, for
+		the update and then for the downloads. Setting `cancel` stops the
+		update and drops the downloads still pending. Then `quota` is
+		enforced, see `enforce_quota`.
+		"""
+		log(f"{self.__class__.__name__}: Syncing")
+		new = self.update(on_progress=on_progress, cancel=cancel)
+		for img in new:
+			self._notify(img)
+		if cancel and cancel.is_set():
+			if auto_dump:
+				self.dump()
+			return new
+
+		# Evicted images (local unset, hash kept) are only downloaded on demand
+		with self.lock:
+			pending = [img for img in self.data if not img.local and img.hash is None]
+		done = 0
+		lock = Lock()
+		def on_done(prov, img: ImageBase, error):
+			nonlocal done
+			with lock:
+				done += 1
+				n = done
+			if on_progress:
+				on_progress(n, len(pending))
+
+		if pending:
+			from .scheduler import get_scheduler
+			scheduler = get_scheduler(n_jobs)
+			batch = scheduler.put_many(self, pending, scheduler.batch(on_done))
+			while not batch.wait(0.5):
+				if cancel and cancel.is_set():
+					batch.cancel()
+
+		if self.COMPACT is not None and not (cancel and cancel.is_set()):
+			self.compact_images(pending)
+
+		self.enforce_quota(quota, auto_dump, dump_self=False)
+		if auto_dump:
+			self.dump()
+		return new
+
 	@staticmethod
 	def set_file_date(f: Path, d: datetime):
 		a_time = f.stat().st_mtime
@@ -146,13 +342,24 @@ class ProviderBase(UserList):
 		os.utime(f, (a_time, m_time))
 
 	def _download_img_set(self, img, data, f_path):
-		image = Image.open(f_path)
-		img.local = f_path.relative_to(CACHE_DIR)
-		img.size = len(data)
-		img.hash = sha256(data).hexdigest()
-		img.format = image.format
-		img.resolution = image.size
-		self.set_file_date(f_path, self.to_datetime(img.date))
+		with Image.open(f_path) as image:
+			info = FileInfo(f_path, len(data), sha256(data).hexdigest(), image.format, image.size)
+		self._file_info_set(img, info)
+
+	def _file_info_set(self, img, info: FileInfo):
+		self.set_file_date(info.f_path, self.to_datetime(img.date))
+		with self.lock:
+			img.compact = None
+			img.local = info.f_path.relative_to(CACHE_DIR)
+			img.size = info.size
+			img.hash = info.hash
+			img.format = info.format
+			img.resolution = info.resolution
+
+	def _fetch(self, url: str, params: Optional[dict] = None) -> bytes:
+		# Every upstream request goes through here, see providers.transport
+		from .transport import get_transport
+		return get_transport().get(url, params)
 
 	def download_image(self, img: ImageBase, overwrite: bool = False, auto_dump: bool = False):
 		f_path = self.IMG_DIR / img.f_name
@@ -165,15 +372,18 @@ class ProviderBase(UserList):
 				return
 			elif f_path.is_file():
 				log(f'\t\tSKIPPED (exists on FS) {f_path}')
-				data = f_path.read_bytes()
-				self._download_img_set(img, data, f_path)
-				return
-
-		res = requests.get(img.url)
-		assert res.status_code == 200
-		log(f'\t\t{len(res.content)}bytes -> {f_path}')
-		f_path.write_bytes(res.content)
-		self._download_img_set(img, res.content, f_path)
+				info = self.file_info(f_path)
+				if info.error is None:
+					self._file_info_set(img, info)
+					self._notify(img)
+					return
+				log(f'\t\tCORRUPT ({info.error}), downloading again')
+
+		content = self._fetch(img.url)
+		log(f'\t\t{len(content)}bytes -> {f_path}')
+		f_path.write_bytes(content)
+		self._download_img_set(img, content, f_path)
+		self._notify(img)
 
 		if auto_dump:
 			self.dump()
@@ -182,6 +392,7 @@ class ProviderBase(UserList):
 						images: Optional[list[ImageBase]] = None,
 						overwrite: bool = False,
 						auto_dump: bool = True,
+						quota: Optional[QuotaManager] = None,
 	):
 		log(f"{self.__class__.__name__}: Downloading images")
 		if not images:
@@ -190,6 +401,7 @@ class ProviderBase(UserList):
 		for img in images:
 			self.download_image(img, overwrite=overwrite, auto_dump=False)
 
+		self.enforce_quota(quota, auto_dump, dump_self=False)
 		if auto_dump:
 			self.dump()
 
@@ -198,23 +410,205 @@ class ProviderBase(UserList):
 						overwrite: bool = False,
 						auto_dump: bool = True,
 						n_jobs: int = 8,
+						quota: Optional[QuotaManager] = None,
 	):
 		log(f"{self.__class__.__name__}: Downloading images async")
 		if not images:
 			images = self.data
 
-		pool = ThreadWorkerPoll(self.download_image, n_jobs)
-
-		for img in images:
-			pool.put(img)
-			# self.download_image(img, overwrite=overwrite, auto_dump=False)
+		# Workers are shared with the other providers, newest images first
+		from .scheduler import get_scheduler
+		batch = get_scheduler(n_jobs).put_many(self, images, overwrite=overwrite)
 		try:
-			pool.join()
+			batch.wait()
 		except:
-			pool.stop()
+			batch.cancel()
+			raise
+
+		self.enforce_quota(quota, auto_dump, dump_self=False)
+		if auto_dump:
+			self.dump()
 
+
+	def touch(self, img: ImageBase):
+		"""Record that the image was just used (viewed, set as wallpaper...)"""
+		with self.lock:
+			img.accessed = datetime.now()
+
+	def ensure_local(self, img: ImageBase) -> Path:
+		"""Return the image file, downloading it again if it was evicted."""
+		f_path = img.file
+		if not f_path or not f_path.is_file():
+			with self.lock:
+				img.local = None
+			self.download_image(img)
+			f_path = img.file
+		assert f_path
+		self.touch(img)
+		return f_path
+
+	def evict(self, img: ImageBase):
+		"""Remove the image file, keeping its catalog entry for re-download."""
+		f_path = img.file
+		log(f'{self.__class__.__name__}: Evicting img [{self.date_to_str(img.date)}] {f_path}')
+		if f_path:
+			f_path.unlink(missing_ok=True)
+		with self.lock:
+			img.local = None
+			img.compact = None
+		self._notify(img)
+
+	def compact_images(self, images: Optional[list[ImageBase]] = None, **kwargs):
+		"""Re-encode the originals with the COMPACT settings (see providers.compact)"""
+		from .compact import CompactSettings, compact_images
+		settings = kwargs.pop('settings', None) or self.COMPACT or CompactSettings()
+		return compact_images(self, settings, self.data if images is None else images, **kwargs)
+
+	def fetch_original(self, img: ImageBase) -> Path:
+		"""Download the pristine original of a compacted image again."""
+		compact_file = img.file if img.compact else None
+		recorded_hash = img.hash
+		self.download_image(img, overwrite=True)
+		if recorded_hash and img.hash != recorded_hash:
+			log(f'\t\tORIGINAL CHANGED upstream ({recorded_hash} -> {img.hash})')
+		if compact_file:
+			compact_file.unlink(missing_ok=True)
+		assert img.file
+		return img.file
+
+	def enforce_quota(self, quota: Optional[QuotaManager] = None, auto_dump: bool = True, dump_self: bool = True):
+		"""Evict the least recently used images over the quota.
+
+		By default the quota of this provider, as configured (see
+		providers.quota.QUOTA_FILE). A QuotaManager shared with other
+		providers may evict from them too, and caps them all together.
+		"""
+		from .quota import QuotaManager
+		quota = quota or QuotaManager.configured([self])
+		evictions = quota.enforce(auto_dump=False)
 		if auto_dump:
+			evicted = {id(prov): prov for prov, _ in evictions}
+			if not dump_self:
+				evicted.pop(id(self), None)
+			for prov in evicted.values():
+				prov.dump()
+		return evictions
+
+
+	@staticmethod
+	def file_info(f_path: Path, verify: bool = False) -> FileInfo:
+		"""Size, hash, format and resolution, or the error reading them.
+
+		With `verify` the image is fully decoded: Image.verify() checks
+		nothing on JPEG, so a truncated one would pass. That relies on
+		ImageFile.LOAD_TRUNCATED_IMAGES staying off.
+		"""
+		info = FileInfo(f_path, 0)
+		try:
+			info.size = f_path.stat().st_size
+			info.hash = hash_file(f_path)
+			with Image.open(f_path) as image:
+				info.format = image.format
+				info.resolution = image.size
+				if verify:
+					image.load()
+		except Exception as e:
+			info.error = f'{type(e).__name__}: {e}'
+		return info
+
+	def _scan_unchanged(self, img: ImageBase, st: os.stat_result) -> bool:
+		# Downloads set the file mtime to the image date, so a file that
+		# still has it and the recorded size wasn't touched since.
+		if not (img.local and img.hash and img.format and img.resolution):
+			return False
+		m_time = self.to_datetime(img.date).timestamp()
+		return img.stored_size == st.st_size and abs(st.st_mtime - m_time) < 1
+
+	def scan_cache(self,
+					verify: bool = False,
+					update: bool = True,
+					auto_dump: bool = True,
+					n_jobs: int = 8,
+	) -> ScanReport:
+		"""Match the images on IMG_DIR and COMPACT_DIR against the catalog.
+
+		Files whose size and mtime match the catalog are skipped, unless
+		`verify` is set, then everything is hashed and fully decoded.
+		With `update`, the local file data is filled in on the catalog
+		and entries with missing files get unlinked from them.
+		"""
+		log(f"{self.__class__.__name__}: Scanning cache (dir={self.IMG_DIR})")
+		report = ScanReport(self.SHORT_NAME)
+
+		on_fs: dict[Path, os.stat_result] = {}
+		for directory in (self.IMG_DIR, self.COMPACT_DIR):
+			if not directory.is_dir():
+				continue
+			with os.scandir(directory) as it:
+				for entry in it:
+					if entry.is_file():
+						on_fs[Path(entry.path)] = entry.stat()
+
+		to_hash: list[tuple[ImageBase, Path]] = []
+		claimed: set[Path] = set()
+		with self.lock:
+			images = list(self.data)
+		for img in images:
+			f_path = img.file or self.IMG_DIR / img.f_name
+			claimed.add(f_path)
+			if img.compact:
+				# The original may have been kept along
+				claimed.add(self.IMG_DIR / img.f_name)
+			st = on_fs.get(f_path)
+			if st is None:
+				if img.local:
+					report.missing.append(img)
+			elif not verify and self._scan_unchanged(img, st):
+				report.skipped.append(img)
+			else:
+				to_hash.append((img, f_path))
+		report.orphaned = sorted(f for f in on_fs if f not in claimed)
+
+		results: dict[Path, FileInfo] = {}
+		if to_hash:
+			log(f"{self.__class__.__name__}: \tHashing {len(to_hash)} files")
+			f_paths = list({f_path for _, f_path in to_hash})
+			with ThreadPoolExecutor(min(n_jobs, len(f_paths))) as pool:
+				infos = pool.map(lambda f_path: self.file_info(f_path, verify), f_paths)
+				results = dict(zip(f_paths, infos))
+
+		for img, f_path in to_hash:
+			info = results[f_path]
+			if info.error is not None and not f_path.is_file():
+				# Removed since listed
+				if img.local:
+					report.missing.append(img)
+			elif info.error is not None:
+				report.corrupt.append((img, info.error))
+			elif img.stored_hash and img.stored_hash != info.hash:
+				report.corrupt.append((img, f'hash mismatch ({img.stored_hash} != {info.hash})'))
+			elif img.compact:
+				report.verified.append(img)
+			elif img.hash:
+				report.verified.append(img)
+				if update:
+					self._file_info_set(img, info)
+			else:
+				report.imported.append(img)
+				if update:
+					self._file_info_set(img, info)
+
+		if update:
+			with self.lock:
+				for img in report.missing:
+					img.local = None
+			for img in report.imported + report.verified + report.missing:
+				self._notify(img)
+
+		log(f"{self.__class__.__name__}: \t{report.summary()}")
+		if update and auto_dump and (report.imported or report.verified or report.missing):
 			self.dump()
+		return report
 
 
 	_iso_format_pattern = re.compile(r'\d{4}-\d{2}-\d{2}')
@@ -5,10 +5,12 @@ from dataclasses import dataclass
 from urllib.parse import urlparse, parse_qs
 from datetime import datetime
 from pathlib import Path
+from threading import Event
+from typing import Optional
+import json
 import re
 
-import requests
-
+from .archive import Snapshot
 from .base import ImageBase, ProviderBase, CACHE_DIR, log
 
 
@@ -40,6 +42,8 @@ class BingProvider(ProviderBase):
 
 	DATA_DIR = CACHE_DIR / SHORT_NAME
 	IMG_DIR = DATA_DIR / 'imgs'
+	COMPACT_DIR = DATA_DIR / 'compact'
+	RAW_DIR = DATA_DIR / 'raw'
 	DATA_FILE = DATA_DIR / f'{SHORT_NAME}.yaml'
 
 	data: list[BingImage]
@@ -54,26 +58,63 @@ class BingProvider(ProviderBase):
 	}
 
 	def download(self, idx=0):
-		if not self.data:
-			self.data = []
-		self.data += self.download_info(idx)
+		self.update(idx)
 		self.dump()
 
+	def update(self, idx=0, on_progress=None, cancel: Optional[Event] = None) -> list[BingImage]:
+		# A single request, nothing to report or cancel midway
+		if cancel and cancel.is_set():
+			return []
+		imgs = self.download_info(idx)
+		with self.lock:
+			if not self.data:
+				self.data = []
+			known = {img.f_name for img in self.data}
+			new = [img for img in imgs if img.f_name not in known]
+			self.data += new
+		self.index_search(new)
+		return new
+
+	def search_fields(self, img: BingImage) -> dict[str, Optional[str]]:
+		return {
+			'title': img.title,
+			'copyright': img.about,
+		}
+
 	def download_info(self, idx=0, save_raw=True):
 		log(f"{type(self).__name__}: Downloading info")
-		params = self.BASE_PARAMS
-		params['idx'] = idx
-		res = requests.get(self.BASE_URL, params=params)
-		assert res.status_code == 200
+		params = dict(self.BASE_PARAMS, idx=idx)
+		content = self._fetch(self.BASE_URL, params)
 		if save_raw:
-			now = datetime.now().strftime("%Y%m%d_%H%M%S")
-			f_path = self.DATA_DIR / 'raw' / f'bing_{now}.json'
-			log(f"{type(self).__name__}: \tSaving info (file={f_path})")
-			f_path.write_bytes(res.content)
-
-		imgs_raw = res.json()['images']
-		imgs = list(map(self.process_image_info, imgs_raw))
-		return imgs
+			self.raw.put(self.raw_name(params), content)
+		return self.parse_info(content)
+
+	@staticmethod
+	def raw_name(params: dict) -> str:
+		return f"HPImageArchive_{params['mkt']}_{params['idx']}_{params['n']}.json"
+
+	def parse_info(self, content: bytes) -> list[BingImage]:
+		imgs_raw = json.loads(content)['images']
+		return list(map(self.process_image_info, imgs_raw))
+
+	def reparse(self, snapshot: Snapshot) -> list[BingImage]:
+		"""The entries of an archived response (see `self.raw.snapshots()`)."""
+		return self.parse_info(self.raw.read(snapshot))
+
+	_LEGACY_RAW_PATTERN = re.compile(r'bing_(\d{8}_\d{6})\.json')
+
+	def import_legacy_raw(self, remove: bool = True) -> int:
+		"""Move the bing_*.json files of older versions into the raw archive."""
+		f_paths = sorted(self.RAW_DIR.glob('bing_*.json'))
+		log(f"{type(self).__name__}: Importing {len(f_paths)} raw files (dir={self.RAW_DIR})")
+		name = self.raw_name(self.BASE_PARAMS)
+		for f_path in f_paths:
+			m = self._LEGACY_RAW_PATTERN.fullmatch(f_path.name)
+			if not m:
+				continue
+			fetched = datetime.strptime(m.group(1), "%Y%m%d_%H%M%S")
+			self.raw.import_file(name, f_path, fetched, remove=remove)
+		return len(f_paths)
 
 	def process_image_info(self, info: dict) -> BingImage:
 		f_name, id_str, id_num, ext, res = url_extract_info(info['url'])
@@ -107,10 +148,9 @@ class BingProvider(ProviderBase):
 					img.local = f_path.relative_to(CACHE_DIR)
 					continue
 
-			res = requests.get(img.url)
-			assert res.status_code == 200
-			log(f'\t\t{len(res.content)}bytes -> {f_path}')
-			f_path.write_bytes(res.content)
+			content = self._fetch(img.url)
+			log(f'\t\t{len(content)}bytes -> {f_path}')
+			f_path.write_bytes(content)
 			img.local = f_path.relative_to(CACHE_DIR)
 			self.set_file_date(f_path, self.to_datetime(img.date))
 		
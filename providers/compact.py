@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Optional
+import multiprocessing
+
+from PIL import Image
+
+from .base import CACHE_DIR, CompactInfo, ImageBase, ProviderBase, hash_file, log
+
+
+##### SETTINGS #####
+
+@dataclass
+class CompactSettings:
+	format: str = 'WEBP'	# WEBP or JPEG
+	quality: int = 85
+	max_dim: Optional[int] = 3840	# longest side, None keeps the resolution
+
+	EXTENSIONS = {'WEBP': '.webp', 'JPEG': '.jpg'}
+
+	@property
+	def extension(self) -> str:
+		return self.EXTENSIONS[self.format]
+
+
+##### TRANSCODING #####
+
+def _decode_time(f_path: Path) -> float:
+	t = perf_counter()
+	with Image.open(f_path) as image:
+		image.load()
+	return perf_counter() - t
+
+def transcode(src: Path, dst: Path, settings: CompactSettings) -> dict:
+	"""Re-encode `src` into `dst`, timing the decode of both.
+
+	Runs on the worker processes, so it only touches the files, the
+	catalog is updated with the result on the main process.
+	"""
+	t = perf_counter()
+	with Image.open(src) as image:
+		image.load()
+		decode_original = perf_counter() - t
+
+		if image.mode not in ('RGB', 'L'):
+			image = image.convert('RGB')
+		if settings.max_dim:
+			image.thumbnail((settings.max_dim, settings.max_dim), Image.LANCZOS)
+		image.save(dst, format=settings.format, quality=settings.quality)
+		resolution = image.size
+
+	return {
+		'size': dst.stat().st_size,
+		'hash': hash_file(dst),
+		'resolution': resolution,
+		'decode_original': decode_original,
+		'decode_compact': _decode_time(dst),
+	}
+
+
+##### REPORT #####
+
+@dataclass
+class CompactRow:
+	f_name: str
+	original_size: int
+	compact_size: int
+	decode_original: float
+	decode_compact: float
+	kept: bool		# True if the compact one wasn't smaller, so the original stays
+
+
+@dataclass
+class CompactReport:
+	provider: str
+	rows: list[CompactRow] = field(default_factory=list)
+	skipped: int = 0
+	errors: list[tuple[str, str]] = field(default_factory=list)
+
+	@property
+	def compacted(self) -> list[CompactRow]:
+		return [r for r in self.rows if not r.kept]
+
+	def format(self, details: bool = False) -> str:
+		from .quota import format_size
+
+		lines = []
+		if details:
+			lines.append('f_name\toriginal\tcompact\tdecode original\tdecode compact')
+			for r in self.rows:
+				compact = '(kept)' if r.kept else format_size(r.compact_size)
+				lines.append(f'{r.f_name}\t{format_size(r.original_size)}\t{compact}\t'
+					f'{r.decode_original * 1000:.1f}ms\t{r.decode_compact * 1000:.1f}ms')
+
+		rows = self.compacted
+		before = sum(r.original_size for r in rows)
+		after = sum(r.compact_size for r in rows)
+		dec_before = sum(r.decode_original for r in rows)
+		dec_after = sum(r.decode_compact for r in rows)
+		lines.append(f'{self.provider}: {len(rows)} compacted, '
+			f'{len(self.rows) - len(rows)} kept original, {self.skipped} skipped, '
+			f'{len(self.errors)} errors')
+		if rows:
+			lines.append(f'\tbytes:  {format_size(before)} -> {format_size(after)} '
+				f'({format_size(before - after)} saved, {after / before:.1%})')
+		if rows and dec_before:
+			lines.append(f'\tdecode: {dec_before:.2f}s -> {dec_after:.2f}s ({dec_after / dec_before:.1%})')
+		return '\n'.join(lines)
+
+
+##### PROVIDER #####
+
+def compact_images(
+		prov: ProviderBase,
+		settings: CompactSettings,
+		images: list[ImageBase],
+		keep_originals: bool = False,
+		auto_dump: bool = True,
+		n_jobs: Optional[int] = None,
+) -> CompactReport:
+	"""Replace the original files of `images` by compact re-encodes.
+
+	The CPU bound work runs on a process pool. The image hash, size,
+	format and resolution keep describing the original, the compact file
+	goes to `img.compact`, and `prov.fetch_original` gets it back. Images
+	already compacted, or not stored locally, are skipped.
+	"""
+	log(f"{prov.__class__.__name__}: Compacting images ({settings})")
+	report = CompactReport(prov.SHORT_NAME)
+	prov.COMPACT_DIR.mkdir(parents=True, exist_ok=True)
+
+	tasks = {}
+	# Spawned, not forked: the caller may be running download and GUI
+	# threads, holding locks a forked child would inherit held
+	with ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('spawn')) as pool:
+		for img in images:
+			src = img.file
+			if img.compact or not src or not src.is_file():
+				report.skipped += 1
+				continue
+			# The full name, or x.jpg and x.png would both go to x.webp
+			dst = prov.COMPACT_DIR / (img.f_name + settings.extension)
+			tmp = dst.with_name(dst.name + '.tmp')
+			tasks[pool.submit(transcode, src, tmp, settings)] = (img, src, dst, tmp)
+
+		for future in as_completed(tasks):
+			img, src, dst, tmp = tasks[future]
+			try:
+				res = future.result()
+			except Exception as e:
+				tmp.unlink(missing_ok=True)
+				report.errors.append((img.f_name, f'{type(e).__name__}: {e}'))
+				continue
+
+			original_size = img.size or src.stat().st_size
+			kept = res['size'] >= original_size
+			report.rows.append(CompactRow(img.f_name, original_size, res['size'],
+				res['decode_original'], res['decode_compact'], kept))
+			if kept:
+				tmp.unlink()
+				continue
+
+			tmp.replace(dst)
+			prov.set_file_date(dst, prov.to_datetime(img.date))
+			with prov.lock:
+				img.compact = CompactInfo(res['size'], res['hash'], settings.format,
+					res['resolution'], settings.quality)
+				img.local = dst.relative_to(CACHE_DIR)
+			if not keep_originals:
+				src.unlink()
+			prov._notify(img)
+
+	for f_name, error in report.errors:
+		log(f'\t\tERROR compacting {f_name}: {error}')
+	if auto_dump and report.compacted:
+		prov.dump()
+	return report
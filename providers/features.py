@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from threading import RLock
+from typing import Iterable, Optional
+
+import numpy as np
+from PIL import Image
+
+from .base import CACHE_DIR, ImageBase, ProviderBase, log
+
+
+##### EXTRACTION #####
+
+THUMB_SIZE = 64		# features come from a decode downsampled to this
+HIST_LEVELS = 4		# per channel, so HIST_LEVELS ** 3 bins
+HIST_BINS = HIST_LEVELS ** 3
+N_DOMINANT = 3
+
+# Rec. 709 luma weights
+_LUMA = np.array([0.2126, 0.7152, 0.0722], np.float32)
+
+
+@dataclass
+class ColorFeatures:
+	hist: np.ndarray		# (HIST_BINS,) uint8, fraction of pixels * 255
+	dominant: np.ndarray	# (N_DOMINANT, 3) uint8 RGB, most common first
+	luminance: float		# mean, 0 to 1
+	resolution: tuple[int, int]
+
+
+def extract_features(f_path: Path) -> ColorFeatures:
+	with Image.open(f_path) as image:
+		resolution = image.size
+		# JPEG can be decoded straight into a smaller scale, way faster
+		image.draft('RGB', (THUMB_SIZE * 2, THUMB_SIZE * 2))
+		image = image.convert('RGB')
+		image.thumbnail((THUMB_SIZE, THUMB_SIZE))
+		pixels = np.asarray(image, np.uint8).reshape(-1, 3)
+
+	levels = pixels // (256 // HIST_LEVELS)
+	bins = (levels[:, 0].astype(np.intp) * HIST_LEVELS + levels[:, 1]) * HIST_LEVELS + levels[:, 2]
+	counts = np.bincount(bins, minlength=HIST_BINS)
+	hist = np.round(counts * 255 / len(pixels)).astype(np.uint8)
+
+	# Dominant colors are the mean color of the most populated bins
+	top = np.argsort(counts, kind='stable')[::-1][:N_DOMINANT]
+	top = [b for b in top if counts[b]] or [top[0]]
+	dominant = np.array([pixels[bins == b].mean(axis=0) for b in top])
+	dominant = np.resize(dominant, (N_DOMINANT, 3)).round().astype(np.uint8)
+
+	luminance = float((pixels.astype(np.float32) @ _LUMA).mean() / 255)
+	return ColorFeatures(hist, dominant, luminance, resolution)
+
+
+##### STORE #####
+
+@dataclass
+class FeatureMatch:
+	provider: str
+	f_name: str
+	luminance: float
+	distance: float		# to the query color, 0 without one
+
+
+class FeatureStore:
+	"""Color features of all the catalogs, as NumPy columns.
+
+	Keyed by provider and f_name, and saved as a single compressed .npz,
+	so queries are vectorized over the whole catalog.
+	"""
+
+	FILE = CACHE_DIR / 'features.npz'
+	INITIAL_CAPACITY = 1024
+
+	def __init__(self):
+		self.lock = RLock()
+		self.keys: list[tuple[str, str]] = []
+		self._rows: dict[tuple[str, str], int] = {}
+		self._alloc(self.INITIAL_CAPACITY)
+
+	def __len__(self):
+		return len(self.keys)
+
+	def __contains__(self, key: tuple[str, str]):
+		return key in self._rows
+
+	def _alloc(self, capacity: int):
+		old = getattr(self, '_cols', None)
+		self._cols = {
+			'hist': np.zeros((capacity, HIST_BINS), np.uint8),
+			'dominant': np.zeros((capacity, N_DOMINANT, 3), np.uint8),
+			'luminance': np.zeros(capacity, np.float32),
+			'width': np.zeros(capacity, np.int32),
+			'height': np.zeros(capacity, np.int32),
+		}
+		if old:
+			n = len(self.keys)
+			for name, col in old.items():
+				self._cols[name][:n] = col[:n]
+
+	def column(self, name: str) -> np.ndarray:
+		return self._cols[name][:len(self.keys)]
+
+	def add(self, provider: str, f_name: str, features: ColorFeatures):
+		key = (provider, f_name)
+		with self.lock:
+			row = self._rows.get(key)
+			if row is None:
+				row = len(self.keys)
+				capacity = len(self._cols['luminance'])
+				if row >= capacity:
+					self._alloc(capacity * 2)
+				self.keys.append(key)
+				self._rows[key] = row
+			cols = self._cols
+			cols['hist'][row] = features.hist
+			cols['dominant'][row] = features.dominant
+			cols['luminance'][row] = features.luminance
+			cols['width'][row], cols['height'][row] = features.resolution
+
+
+	def save(self, f_path: Path = None):
+		f_path = f_path or self.FILE
+		log(f"{type(self).__name__}: Dumping features (file={f_path})")
+		with self.lock:
+			keys = np.array([f'{p}/{f}' for p, f in self.keys], dtype=str)
+			cols = {name: self.column(name) for name in self._cols}
+			f_path.parent.mkdir(parents=True, exist_ok=True)
+			with f_path.open('wb') as f:
+				np.savez_compressed(f, keys=keys, **cols)
+
+	@classmethod
+	def load(cls, f_path: Path = None) -> FeatureStore:
+		f_path = f_path or cls.FILE
+		store = cls()
+		if not f_path.is_file():
+			return store
+		log(f"{cls.__name__}: Loading features (file={f_path})")
+		with np.load(f_path) as data:
+			store.keys = [tuple(k.split('/', 1)) for k in data['keys'].tolist()]	# type: ignore
+			store._rows = {k: i for i, k in enumerate(store.keys)}
+			store._cols = {name: data[name] for name in store._cols}
+			# _alloc keeps room to add more
+			store._alloc(max(cls.INITIAL_CAPACITY, 2 * len(store.keys)))
+		return store
+
+
+	def attach(self, prov: ProviderBase):
+		"""Extract the features of the images of `prov` as they get downloaded."""
+		prov.add_listener(self.on_image)
+
+	def on_image(self, prov: ProviderBase, img: ImageBase):
+		f_path = img.file
+		if not f_path or (prov.SHORT_NAME, img.f_name) in self:
+			return
+		try:
+			self.add(prov.SHORT_NAME, img.f_name, extract_features(f_path))
+		except Exception as e:
+			log(f"{type(self).__name__}: Error extracting features ({f_path=}): {e}")
+
+	def extract(self, prov: ProviderBase, force: bool = False, n_jobs: int = 8) -> int:
+		"""Extract the missing features of all the local images of `prov`."""
+		images = [
+			img for img in prov
+			if img.local and (force or (prov.SHORT_NAME, img.f_name) not in self)
+		]
+		log(f"{type(self).__name__}: Extracting features of {len(images)} images ({prov.SHORT_NAME})")
+		if not images:
+			return 0
+
+		with ThreadPoolExecutor(min(n_jobs, len(images))) as pool:
+			futures = {pool.submit(extract_features, img.file): img for img in images}	# type: ignore
+			for future in as_completed(futures):
+				img = futures[future]
+				try:
+					self.add(prov.SHORT_NAME, img.f_name, future.result())
+				except Exception as e:
+					log(f"{type(self).__name__}: Error extracting features (f_path={img.file}): {e}")
+		return len(images)
+
+
+	def query(self,
+				n: Optional[int] = 20,
+				order: str = 'luminance',
+				reverse: bool = False,
+				color: Optional[tuple[int, int, int]] = None,
+				max_distance: Optional[float] = None,
+				min_luminance: Optional[float] = None,
+				max_luminance: Optional[float] = None,
+				landscape: Optional[bool] = None,
+				providers: Optional[Iterable[str]] = None,
+	) -> list[FeatureMatch]:
+		"""Select images by color, eg: the darkest 20 landscape images near a color.
+
+		`color` is compared to the dominant colors of each image (RGB
+		euclidean distance, the nearest of them). `order` is 'luminance'
+		(darkest first) or 'distance' (nearest first), `reverse` flips it.
+		"""
+		with self.lock:
+			count = len(self.keys)
+			mask = np.ones(count, np.bool_)
+			luminance = self.column('luminance')
+
+			distance = np.zeros(count, np.float32)
+			if color is not None:
+				diff = self.column('dominant').astype(np.float32) - np.asarray(color, np.float32)
+				distance = np.sqrt((diff ** 2).sum(axis=2)).min(axis=1)
+				if max_distance is not None:
+					mask &= distance <= max_distance
+
+			if min_luminance is not None:
+				mask &= luminance >= min_luminance
+			if max_luminance is not None:
+				mask &= luminance <= max_luminance
+			if landscape is not None:
+				mask &= (self.column('width') > self.column('height')) == landscape
+			if providers is not None:
+				names = set(providers)
+				mask &= np.array([p in names for p, _ in self.keys], np.bool_)
+
+			rows = np.flatnonzero(mask)
+			values = {'luminance': luminance, 'distance': distance}[order][rows]
+			rows = rows[np.argsort(values, kind='stable')]
+			if reverse:
+				rows = rows[::-1]
+			if n is not None:
+				rows = rows[:n]
+
+			return [
+				FeatureMatch(*self.keys[row], float(luminance[row]), float(distance[row]))
+				for row in rows
+			]
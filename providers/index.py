@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from threading import RLock
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .base import ImageBase, ProviderBase, date_t
+
+
+##### CATALOG INDEX #####
+
+class CatalogIndex:
+	"""Columnar view over the catalogs of several providers.
+
+	Every image is a row, and each field we filter or sort by is a NumPy
+	column, so queries are vectorized instead of walking the dataclasses.
+	Rows are only appended, never removed, so a row number is stable and
+	can be kept by the views (eg: the gallery cards).
+	"""
+
+	COLUMNS = {
+		'date': np.int32,	# date ordinal
+		'width': np.int32,
+		'height': np.int32,
+		'size': np.int64,
+		'provider': np.int16,
+		'format': np.int16,
+		'local': np.bool_,
+	}
+	INITIAL_CAPACITY = 1024
+
+	def __init__(self, providers: Iterable[ProviderBase] = ()):
+		self.lock = RLock()
+		self.providers: list[ProviderBase] = []
+		# Providers are UserLists, so == compares catalogs (all the empty
+		# ones are equal): they're looked up by identity.
+		self._prov_ids: dict[int, int] = {}	# id(prov) -> index on providers
+		self.images: list[ImageBase] = []
+		self.formats: list[Optional[str]] = [None]
+		self.listeners = []
+		self._rows: dict[int, int] = {}		# id(img) -> row
+		self._cols = {
+			name: np.zeros(self.INITIAL_CAPACITY, dtype)
+			for name, dtype in self.COLUMNS.items()
+		}
+		for prov in providers:
+			self.add_provider(prov)
+
+	def __len__(self):
+		return len(self.images)
+
+	def column(self, name: str) -> np.ndarray:
+		return self._cols[name][:len(self.images)]
+
+	def __getitem__(self, row: int) -> tuple[ProviderBase, ImageBase]:
+		return self.providers[self.column('provider')[row]], self.images[row]
+
+	def row(self, img: ImageBase) -> Optional[int]:
+		return self._rows.get(id(img))
+
+	def add_listener(self, listener):
+		"""Call `listener(row, new)` whenever a row is added or updated."""
+		self.listeners.append(listener)
+
+
+	def add_provider(self, prov: ProviderBase):
+		with self.lock:
+			prov_id = self._prov_ids[id(prov)] = len(self.providers)
+			self.providers.append(prov)
+			for img in prov:
+				self._set_row(prov_id, img)
+		prov.add_listener(self.update)
+
+	def remove_provider(self, prov: ProviderBase):
+		prov.remove_listener(self.update)
+
+	def update(self, prov: ProviderBase, img: ImageBase):
+		"""Insert or refresh the row of a image, safe to call from workers."""
+		with self.lock:
+			prov_id = self._prov_ids[id(prov)]
+			new = id(img) not in self._rows
+			row = self._set_row(prov_id, img)
+		for listener in self.listeners:
+			listener(row, new)
+
+	def _format_id(self, fmt: Optional[str]) -> int:
+		try:
+			return self.formats.index(fmt)
+		except ValueError:
+			self.formats.append(fmt)
+			return len(self.formats) - 1
+
+	def _grow(self, n: int):
+		capacity = len(self._cols['date'])
+		if n <= capacity:
+			return
+		while capacity < n:
+			capacity *= 2
+		for name, col in self._cols.items():
+			new_col = np.zeros(capacity, col.dtype)
+			new_col[:len(col)] = col
+			self._cols[name] = new_col
+
+	def _set_row(self, prov_id: int, img: ImageBase) -> int:
+		row = self._rows.get(id(img))
+		if row is None:
+			row = len(self.images)
+			self._grow(row + 1)
+			self.images.append(img)
+			self._rows[id(img)] = row
+
+		w, h = img.resolution or (0, 0)
+		cols = self._cols
+		cols['date'][row] = self.providers[prov_id].to_date(img.date).toordinal()
+		cols['width'][row] = w
+		cols['height'][row] = h
+		cols['size'][row] = img.size or 0
+		cols['provider'][row] = prov_id
+		cols['format'][row] = self._format_id(img.format)
+		cols['local'][row] = bool(img.local)
+		return row
+
+
+	def filter(self,
+				date_from: Optional[date_t] = None,
+				date_to: Optional[date_t] = None,
+				min_width: Optional[int] = None,
+				min_height: Optional[int] = None,
+				min_aspect: Optional[float] = None,
+				max_aspect: Optional[float] = None,
+				formats: Optional[Iterable[str]] = None,
+				providers: Optional[Iterable[str]] = None,
+				local: Optional[bool] = None,
+	) -> np.ndarray:
+		"""Return the rows matching all the given criteria.
+
+		Aspect is width / height, rows without a resolution never match
+		an aspect criterion. `providers` are matched by SHORT_NAME.
+		"""
+		with self.lock:
+			n = len(self.images)
+			mask = np.ones(n, np.bool_)
+
+			if date_from is not None:
+				mask &= self.column('date') >= ProviderBase.to_date(date_from).toordinal()
+			if date_to is not None:
+				mask &= self.column('date') <= ProviderBase.to_date(date_to).toordinal()
+			if min_width is not None:
+				mask &= self.column('width') >= min_width
+			if min_height is not None:
+				mask &= self.column('height') >= min_height
+			if min_aspect is not None or max_aspect is not None:
+				aspect = self.aspect()
+				if min_aspect is not None:
+					mask &= aspect >= min_aspect
+				if max_aspect is not None:
+					mask &= aspect <= max_aspect
+			if formats is not None:
+				names = set(formats)
+				ids = [i for i, fmt in enumerate(self.formats) if fmt in names]
+				mask &= np.isin(self.column('format'), ids)
+			if providers is not None:
+				names = set(providers)
+				ids = [i for i, p in enumerate(self.providers) if p.SHORT_NAME in names]
+				mask &= np.isin(self.column('provider'), ids)
+			if local is not None:
+				mask &= self.column('local') == local
+
+			return np.flatnonzero(mask)
+
+	def sort(self, rows: Optional[np.ndarray] = None, key: str = 'date', reverse: bool = False) -> np.ndarray:
+		"""Return `rows` (default: all) ordered by the column `key`.
+
+		Besides the columns, `key` can be 'aspect' or 'pixels'.
+		"""
+		with self.lock:
+			if rows is None:
+				rows = np.arange(len(self.images))
+			if key == 'aspect':
+				values = self.aspect()[rows]
+			elif key == 'pixels':
+				values = self.column('width')[rows].astype(np.int64) * self.column('height')[rows]
+			else:
+				values = self.column(key)[rows]
+			order = np.argsort(values, kind='stable')
+			if reverse:
+				order = order[::-1]
+			return rows[order]
+
+	def aspect(self) -> np.ndarray:
+		w = self.column('width').astype(np.float32)
+		h = self.column('height').astype(np.float32)
+		return np.divide(w, h, out=np.full(len(w), np.nan, np.float32), where=h > 0)
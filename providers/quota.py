@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from heapq import heapify, heappop
+from pathlib import Path
+from typing import Iterable, Optional
+import re
+
+import yaml
+
+from .base import CACHE_DIR, ImageBase, ProviderBase, log
+
+
+QUOTA_FILE = CACHE_DIR / 'quota.yaml'
+
+
+_SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?', re.I)
+_SIZE_UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(size: str) -> int:
+	"""Parse sizes like '500M' or '1.5GB' (binary units) into bytes."""
+	m = _SIZE_PATTERN.fullmatch(size.strip())
+	if not m:
+		raise ValueError(f'Invalid size: {size!r}')
+	value, unit = m.groups()
+	return int(float(value) * _SIZE_UNITS[unit.upper()])
+
+def format_size(size: int) -> str:
+	for unit in ('', 'K', 'M', 'G'):
+		if size < 1024:
+			break
+		size /= 1024	# type: ignore
+	else:
+		unit = 'T'
+	return f'{size:.1f}{unit}'
+
+
+def load_quotas(f_path: Path = QUOTA_FILE) -> tuple[Optional[int], dict[str, int]]:
+	"""The total and per provider quotas set on `f_path`, if any, eg:
+
+		total: 20G
+		providers:
+		  apod: 15G
+		  bing: 2G
+	"""
+	if not f_path.is_file():
+		return None, {}
+	settings = yaml.safe_load(f_path.open()) or {}
+	size = lambda v: v if isinstance(v, int) else parse_size(str(v))
+	total = settings.get('total')
+	per_provider = {name: size(v) for name, v in (settings.get('providers') or {}).items()}
+	return (size(total) if total is not None else None), per_provider
+
+
+##### QUOTA MANAGER #####
+
+# (last access, image date, tie breaker, provider, img): the heap pops the
+# least recently used first, never accessed ones before, oldest image first.
+_entry_t = tuple[float, int, int, ProviderBase, ImageBase]
+
+
+class QuotaManager:
+	"""Keep the image cache under the given disk quotas.
+
+	Each provider has its own quota (`per_provider`, defaulting to the
+	provider QUOTA), and `total` caps all of them together. Eviction is
+	LRU on `ImageBase.accessed`, pinned images are never evicted. Sizes
+	come from the catalog, so deciding costs no FS access at all.
+	`configured` takes the quotas from QUOTA_FILE.
+	"""
+
+	def __init__(self,
+				providers: Iterable[ProviderBase],
+				total: Optional[int] = None,
+				per_provider: Optional[dict[str, int]] = None,
+	):
+		self.providers = list(providers)
+		self.total = total
+		self.per_provider = per_provider or {}
+
+	@classmethod
+	def configured(cls, providers: Iterable[ProviderBase], f_path: Path = QUOTA_FILE) -> QuotaManager:
+		return cls(providers, *load_quotas(f_path))
+
+	@property
+	def limited(self) -> bool:
+		return self.total is not None or any(self.quota(p) is not None for p in self.providers)
+
+	def quota(self, prov: ProviderBase) -> Optional[int]:
+		return self.per_provider.get(prov.SHORT_NAME, prov.QUOTA)
+
+	@staticmethod
+	def img_size(img: ImageBase) -> int:
+		if img.stored_size is not None:
+			return img.stored_size
+		f_path = img.file
+		return f_path.stat().st_size if f_path and f_path.is_file() else 0
+
+	def usage(self) -> dict[str, int]:
+		return {
+			p.SHORT_NAME: sum(self.img_size(img) for img in p if img.local)
+			for p in self.providers
+		}
+
+	def _candidates(self, prov: ProviderBase) -> list[_entry_t]:
+		return [
+			(
+				img.accessed.timestamp() if img.accessed else 0.,
+				prov.to_date(img.date).toordinal(),
+				id(img),
+				prov,
+				img,
+			)
+			for img in prov
+			if img.local and not img.pinned
+		]
+
+	def _pop_until(self, heap: list[_entry_t], excess: int, chosen: list[_entry_t]) -> int:
+		heapify(heap)
+		freed = 0
+		while heap and freed < excess:
+			entry = heappop(heap)
+			chosen.append(entry)
+			freed += self.img_size(entry[-1])
+		return freed
+
+	def plan(self) -> list[tuple[ProviderBase, ImageBase]]:
+		"""Return what `enforce` would evict, in eviction order."""
+		if not self.limited:
+			return []
+		usage = self.usage()
+		chosen: list[_entry_t] = []
+		remaining: list[_entry_t] = []
+
+		for prov in self.providers:
+			candidates = self._candidates(prov)
+			quota = self.quota(prov)
+			used = usage[prov.SHORT_NAME]
+			if quota is not None and used > quota:
+				usage[prov.SHORT_NAME] -= self._pop_until(candidates, used - quota, chosen)
+			remaining += candidates
+
+		if self.total is not None:
+			used = sum(usage.values())
+			if used > self.total:
+				self._pop_until(remaining, used - self.total, chosen)
+
+		return [(prov, img) for *_, prov, img in chosen]
+
+	def enforce(self, dry_run: bool = False, auto_dump: bool = True) -> list[tuple[ProviderBase, ImageBase]]:
+		evictions = self.plan()
+		if not evictions:
+			return evictions
+		freed = sum(self.img_size(img) for _, img in evictions)
+		log(f"{type(self).__name__}: Evicting {len(evictions)} images ({format_size(freed)})")
+		if dry_run:
+			return evictions
+
+		for prov, img in evictions:
+			prov.evict(img)
+
+		if auto_dump:
+			for prov in {id(prov): prov for prov, _ in evictions}.values():
+				prov.dump()
+		return evictions
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Optional
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import yaml
+
+from .base import CACHE_DIR, log
+
+
+SIZES = (1_000, 10_000, 100_000)
+HISTORY_FILE = CACHE_DIR / 'scaling_history.yaml'
+
+# Growth exponents over 1 + SUPERLINEAR_TOLERANCE are flagged, eg: 2 for a
+# full dump() per image. The margin absorbs the fixed costs weighing more
+# on the smaller catalogs, and the timing noise.
+SUPERLINEAR_TOLERANCE = 0.25
+# Against the previous commit: exponent up by more than this, or the time
+# on the largest catalog by more than REGRESSION_RATIO
+REGRESSION_EXPONENT = 0.15
+REGRESSION_RATIO = 1.5
+
+# Seconds a single stage run may take. Before each size its time is
+# projected from the ones measured, and the stage stops growing n if
+# it's over. Smaller probe sizes go first, so even the smallest size is
+# projected: a full dump() per image at n=100k would take days.
+BUDGET = 120.
+PROBES = (100, 10)	# fractions of the smallest size
+
+
+##### STAGES #####
+
+def _apod_page(i: int) -> str:
+	return (
+		'<html><body>'
+		'<center><h1>Astronomy Picture of the Day</h1><p>Date</p>'
+		f'<p><a href="image/{i // 1000:04}/synthetic_{i:06}.jpg"><img src="x.jpg"></a></p></center>'
+		f'<center><b> Synthetic {i} </b><br><b> Image Credit: </b> Author {i}</center>'
+		f'<p><b> Explanation: </b> Made up page number {i} for the scaling harness.</p>'
+		'</body></html>'
+	)
+
+def _synthetic_apod():
+	from .apod import ApodProvider
+
+	# The undecorated class, a fresh instance instead of the singleton
+	class SyntheticApod(ApodProvider.__wrapped__):	# type: ignore
+		"""APOD with made up day pages, generated instead of read."""
+		SHORT_NAME = '_synthetic_apod'
+
+		DATA_DIR = CACHE_DIR / SHORT_NAME
+		IMG_DIR = DATA_DIR / 'imgs'
+		COMPACT_DIR = DATA_DIR / 'compact'
+		RAW_DIR = DATA_DIR / 'raw'
+		PAGE_DIR = DATA_DIR / 'pages'
+		DATA_FILE = DATA_DIR / f'{SHORT_NAME}.yaml'
+		STATUS_FILE = DATA_DIR / 'STATUS.yaml'
+		GROUPS_FILE = DATA_DIR / 'STATUS_GROUPS.yaml'
+		PAGES_INDEX_FILE = DATA_DIR / 'PAGES_INDEX.yaml'
+
+		# The 4 digit year keeps 100k page names unique
+		DATE_F_NAME_BASE = 'ap%Y%m%d.html'
+		START = date(1800, 1, 1)
+
+		def get_page(self, f_name: str, cache=True) -> str:
+			return _apod_page((self.page_name2date(f_name) - self.START).days)
+
+		def page_names(self, start: int, stop: int) -> list[str]:
+			return [self.date2page_name(self.START + timedelta(days=i)) for i in range(start, stop)]
+
+	return SyntheticApod()
+
+def setup_process_pages(n: int) -> Callable[[], None]:
+	prov = _synthetic_apod()
+	pages = prov.page_names(0, n)
+	return lambda: prov.process_pages(pages, reset=True)
+
+def _stress_provider(n: int, downloaded: bool):
+	from .stress import StressProvider
+
+	prov = StressProvider()
+	shutil.rmtree(prov.DATA_DIR, ignore_errors=True)
+	prov.IMG_DIR.mkdir(parents=True)
+	prov.data = [prov.entry(i) for i in range(n)]
+	if downloaded:
+		for img in prov.data:
+			img.local = (prov.IMG_DIR / img.f_name).relative_to(CACHE_DIR)
+			img.size = 100
+			img.hash = f'{id(img):064x}'
+			img.format = 'PNG'
+			img.resolution = (16, 16)
+	return prov
+
+def setup_download_images_async(n: int) -> Callable[[], None]:
+	prov = _stress_provider(n, downloaded=False)
+	return lambda: prov.download_images_async()
+
+def setup_load(n: int) -> Callable[[], None]:
+	prov = _stress_provider(n, downloaded=True)
+	prov.dump()
+	return lambda: type(prov)().load()
+
+# name -> setup(n), returning the timed stage
+STAGES: dict[str, Callable[[int], Callable[[], None]]] = {
+	'download_images_async': setup_download_images_async,
+	'process_pages': setup_process_pages,
+	'load': setup_load,
+}
+
+
+##### RESULTS #####
+
+def fit_exponent(sizes: list[int], times: list[float]) -> float:
+	"""Of the growth curve fitted on a log-log scale, time ~ n ** exponent."""
+	slope, _ = np.polyfit(np.log(sizes), np.log(np.maximum(times, 1e-9)), 1)
+	return float(slope)
+
+
+@dataclass
+class StageResult:
+	stage: str
+	sizes: list[int]
+	times: list[float]		# seconds, best of the repeats
+	# First size not run, and its projected time, when over the budget
+	over_budget: Optional[tuple[int, float]] = None
+
+	@property
+	def exponent(self) -> float:
+		return fit_exponent(self.sizes, self.times)
+
+	@property
+	def superlinear(self) -> bool:
+		return self.exponent > 1 + SUPERLINEAR_TOLERANCE
+
+	def as_dict(self) -> dict:
+		d = {'sizes': self.sizes, 'times': self.times, 'exponent': round(self.exponent, 3)}
+		if self.over_budget:
+			d['over_budget'] = list(self.over_budget)
+		return d
+
+
+@dataclass
+class ScalingRun:
+	commit: str
+	date: datetime
+	results: dict[str, StageResult] = field(default_factory=dict)
+
+	def as_dict(self) -> dict:
+		return {
+			'commit': self.commit,
+			'date': self.date.isoformat(timespec='seconds'),
+			'stages': {name: r.as_dict() for name, r in self.results.items()},
+		}
+
+	@classmethod
+	def from_dict(cls, d: dict) -> ScalingRun:
+		run = cls(d['commit'], datetime.fromisoformat(d['date']))
+		for name, r in d['stages'].items():
+			over_budget = tuple(r['over_budget']) if r.get('over_budget') else None
+			run.results[name] = StageResult(name, r['sizes'], r['times'], over_budget)	# type: ignore
+		return run
+
+
+def git_commit() -> str:
+	"""Short hash of HEAD, '+' when the tree has changes, 'unknown' out of git."""
+	repo = Path(__file__).resolve().parent.parent
+	try:
+		commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+			cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+		status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+			cwd=repo, capture_output=True, text=True, check=True).stdout
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+	return commit + ('+' if status.strip() else '')
+
+def load_history(f_path: Path = HISTORY_FILE) -> list[ScalingRun]:
+	if not f_path.is_file():
+		return []
+	return [ScalingRun.from_dict(d) for d in yaml.safe_load(f_path.open()) or []]
+
+def dump_history(history: list[ScalingRun], f_path: Path = HISTORY_FILE):
+	log(f"ScalingRun: Dumping history (file={f_path})")
+	f_path.parent.mkdir(parents=True, exist_ok=True)
+	yaml.safe_dump([run.as_dict() for run in history], f_path.open('w'), sort_keys=False)
+
+
+##### HARNESS #####
+
+def run_scaling(
+		sizes: tuple[int, ...] = SIZES,
+		stages: Optional[list[str]] = None,
+		repeat: int = 1,
+		history_file: Optional[Path] = HISTORY_FILE,
+		budget: float = BUDGET,
+) -> ScalingRun:
+	"""Time each stage on synthetic catalogs of each size.
+
+	Everything runs offline on a temporary working directory, the search
+	db included: the transport is set to replay from an empty store, so
+	any network access fails the stage. A stage stops growing n when the
+	next size is projected over `budget` seconds (see BUDGET). The run is
+	appended to `history_file`, replacing a previous run of the same
+	commit.
+	"""
+	from .transport import Transport, get_transport, set_transport
+
+	stages = stages or list(STAGES)
+	history_file = history_file and history_file.resolve()
+	run = ScalingRun(git_commit(), datetime.now())
+	cwd = os.getcwd()
+	transport = get_transport()
+
+	with TemporaryDirectory(prefix='wpd-scaling-') as tmp:
+		os.chdir(tmp)
+		CACHE_DIR.mkdir()
+		set_transport(Transport('replay', CACHE_DIR / 'transport'))
+		# The search db path is relative to the working dir, so it's
+		# connected again here, and back on the original one afterwards
+		db_open = 'db' in sys.modules and not sys.modules['db'].db.is_closed()
+		from db import db
+		db.close()
+		db.connect()
+		try:
+			for name in stages:
+				run.results[name] = _run_stage(name, sizes, repeat, budget)
+		finally:
+			set_transport(transport)
+			db.close()
+			os.chdir(cwd)
+			if db_open:
+				db.connect()
+
+	if history_file:
+		history = [r for r in load_history(history_file) if r.commit != run.commit]
+		dump_history(history + [run], history_file)
+	return run
+
+
+def _time_stage(name: str, n: int, repeat: int) -> float:
+	best = float('inf')
+	for _ in range(repeat):
+		with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+			stage = STAGES[name](n)
+			t = perf_counter()
+			stage()
+			best = min(best, perf_counter() - t)
+	log(f'ScalingRun: {name} n={n}: {best:.3f}s')
+	return best
+
+def _run_stage(name: str, sizes: tuple[int, ...], repeat: int, budget: float) -> StageResult:
+	probes = sorted({max(sizes[0] // p, 1) for p in PROBES} - set(sizes))
+	measured: list[tuple[int, float]] = []
+	over_budget = None
+	for n in (*probes, *sizes):
+		if measured:
+			# Growing at least linearly from the last size measured
+			last_n, last_t = measured[-1]
+			exponent = 1.
+			if len(measured) > 1:
+				exponent = max(exponent, fit_exponent(*zip(*measured[-2:])))	# type: ignore
+			projected = last_t * (n / last_n) ** exponent
+			if projected > budget:
+				log(f'ScalingRun: {name} n={n}: ~{projected:.0f}s projected, over the budget')
+				over_budget = (n, round(projected, 1))
+				break
+		measured.append((n, _time_stage(name, n, repeat)))
+
+	# Probes only count for the fit if too few sizes got measured
+	fitted = [(n, t) for n, t in measured if n not in probes]
+	if len(fitted) < 2:
+		fitted = measured[-2:]
+	return StageResult(name, *map(list, zip(*fitted)), over_budget)	# type: ignore
+
+
+def flags(result: StageResult, previous: Optional[StageResult] = None) -> list[str]:
+	found = []
+	if result.over_budget:
+		n, projected = result.over_budget
+		found.append(f'OVER BUDGET (n={n} projected at {projected:.0f}s)')
+	if result.superlinear:
+		found.append(f'SUPERLINEAR (n^{result.exponent:.2f})')
+	if previous and previous.sizes[-1] == result.sizes[-1]:
+		if result.exponent - previous.exponent > REGRESSION_EXPONENT:
+			found.append(f'REGRESSION (n^{previous.exponent:.2f} -> n^{result.exponent:.2f})')
+		ratio = result.times[-1] / previous.times[-1]
+		if ratio > REGRESSION_RATIO:
+			found.append(f'REGRESSION ({ratio:.1f}x slower at n={result.sizes[-1]})')
+	return found
+
+def format_report(history: list[ScalingRun], last: int = 5) -> tuple[str, int]:
+	"""Compare the last runs stage by stage, returns the report and how many flags the latest run has."""
+	runs = history[-last:]
+	if not runs:
+		return 'No runs', 0
+	latest = runs[-1]
+	previous = runs[-2] if len(runs) > 1 else None
+	n_flags = 0
+	lines = []
+	for name in latest.results:
+		lines.append(f'{name}:')
+		for run in runs:
+			result = run.results.get(name)
+			if not result:
+				continue
+			times = '  '.join(f'{n}: {t:.3f}s' for n, t in zip(result.sizes, result.times))
+			line = f'\t{run.commit:<10}\tn^{result.exponent:.2f}\t{times}'
+			if run is latest:
+				prev = previous.results.get(name) if previous else None
+				found = flags(result, prev)
+				n_flags += len(found)
+				line += ''.join(f'\t{f}' for f in found)
+			lines.append(line)
+	return '\n'.join(lines), n_flags
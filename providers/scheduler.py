@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from enum import IntEnum
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+from time import perf_counter
+from typing import Callable, Optional
+
+from .base import ImageBase, ProviderBase, log
+
+
+class Priority(IntEnum):
+	REQUESTED = 0	# the user asked for it
+	VISIBLE = 1		# on screen right now
+	DEFAULT = 2		# newest first
+
+
+##### BATCHES #####
+
+class Batch:
+	"""A group of downloads put together, to wait for or cancel them."""
+
+	def __init__(self, scheduler: DownloadScheduler, on_done: Optional[Callable] = None):
+		self.scheduler = scheduler
+		self.on_done = on_done
+		self.total = 0
+		self.done = 0
+		self.cancelled = False
+
+	def wait(self, timeout: Optional[float] = None) -> bool:
+		"""Wait for all the downloads, returns False on timeout."""
+		with self.scheduler.cond:
+			return self.scheduler.cond.wait_for(lambda: self.done >= self.total, timeout)
+
+	def cancel(self):
+		"""Drop the downloads of this batch not started yet."""
+		self.scheduler.cancel(self)
+
+
+@dataclass
+class _Entry:
+	prov: ProviderBase
+	img: ImageBase
+	priority: Priority
+	kwargs: dict
+	batches: list[Batch] = field(default_factory=list)
+	standalone: bool = False	# also put outside any batch, so no batch cancels it
+	key: list = field(default_factory=list)	# current heap entry
+	queued: float = field(default_factory=perf_counter)
+	running: bool = False
+
+
+@dataclass
+class SchedulerStats:
+	queued: int = 0
+	done: int = 0
+	first_done: Optional[float] = None		# since the first put, seconds
+	# Time from being queued (or raised above DEFAULT) to done, for the
+	# images that were requested or visible
+	prioritized_waits: list[float] = field(default_factory=list)
+	newest_done: Optional[float] = None		# when the newest image queued was done
+
+	@property
+	def first_useful(self) -> Optional[float]:
+		if self.prioritized_waits:
+			return min(self.prioritized_waits)
+		return self.newest_done
+
+
+##### SCHEDULER #####
+
+class DownloadScheduler:
+	"""Download workers shared by all providers, picking by priority.
+
+	Requested images go first, then visible ones, then the rest newest
+	first. Priorities can change while queued (eg: an image scrolling in
+	or out of view) without losing the download. The heap uses lazy
+	deletion: a re-prioritized image gets a new heap entry and the old
+	one is marked stale and skipped when popped.
+
+	With `policy='fifo'` the priorities are ignored, to compare with.
+	"""
+
+	def __init__(self, n_jobs: int = 8, policy: str = 'priority'):
+		assert policy in ('priority', 'fifo')
+		self.policy = policy
+		self.cond = Condition()
+		self._heap: list[list] = []
+		self._entries: dict[int, _Entry] = {}	# id(img) -> queued entry
+		self._seq = count()
+		self._start: Optional[float] = None
+		self._newest: Optional[int] = None
+		self.stats = SchedulerStats()
+		self.workers: list[Thread] = []
+		self.add_workers(n_jobs)
+
+	def add_workers(self, n_jobs: int):
+		"""Start workers up to `n_jobs`, there's no shrinking."""
+		with self.cond:
+			for i in range(len(self.workers), n_jobs):
+				t = Thread(name=f'{type(self).__name__} Thread {i}', target=self._thread_loop, daemon=True)
+				self.workers.append(t)
+				t.start()
+
+	def _push(self, entry: _Entry):
+		if self.policy == 'fifo':
+			sort_key = (next(self._seq),)
+		else:
+			date = entry.prov.to_date(entry.img.date).toordinal()
+			sort_key = (entry.priority, -date, next(self._seq))
+		entry.key = [*sort_key, entry]
+		heappush(self._heap, entry.key)
+
+	def batch(self, on_done: Optional[Callable] = None) -> Batch:
+		"""`on_done(prov, img, error)` is called from the workers."""
+		return Batch(self, on_done)
+
+	def put(self,
+			prov: ProviderBase,
+			img: ImageBase,
+			priority: Priority = Priority.DEFAULT,
+			batch: Optional[Batch] = None,
+			**kwargs,
+	):
+		"""Queue a download, or raise the priority of an already queued one."""
+		with self.cond:
+			if self._start is None:
+				self._start = perf_counter()
+				self.stats = SchedulerStats()
+			entry = self._entries.get(id(img))
+			if entry is None:
+				entry = _Entry(prov, img, priority, kwargs)
+				self._entries[id(img)] = entry
+				self.stats.queued += 1
+				self._push(entry)
+				date = prov.to_date(img.date).toordinal()
+				if self._newest is None or date > self._newest:
+					self._newest = date
+			elif priority < entry.priority and not entry.running:
+				self._reprioritize(entry, priority)
+			if batch:
+				entry.batches.append(batch)
+				batch.total += 1
+			else:
+				entry.standalone = True
+			self.cond.notify()
+
+	def put_many(self, prov: ProviderBase, images: list[ImageBase], batch: Optional[Batch] = None, **kwargs) -> Batch:
+		batch = batch or self.batch()
+		for img in images:
+			self.put(prov, img, batch=batch, **kwargs)
+		return batch
+
+	def _reprioritize(self, entry: _Entry, priority: Priority):
+		if priority < Priority.DEFAULT <= entry.priority:
+			entry.queued = perf_counter()
+		entry.priority = priority
+		if self.policy == 'fifo':
+			return	# keeps its place
+		entry.key[-1] = None
+		self._push(entry)
+
+	def prioritize(self, img: ImageBase, priority: Priority):
+		"""Change the priority of a queued image, a no-op if not queued.
+
+		Meant for visibility changes, so it never lowers a REQUESTED image,
+		only `put` sets that.
+		"""
+		with self.cond:
+			entry = self._entries.get(id(img))
+			if not entry or entry.running or entry.priority == Priority.REQUESTED:
+				return
+			if priority != entry.priority:
+				self._reprioritize(entry, priority)
+
+	def cancel(self, batch: Batch):
+		with self.cond:
+			batch.cancelled = True
+			for key, entry in list(self._entries.items()):
+				if batch not in entry.batches or entry.running:
+					continue
+				entry.batches.remove(batch)
+				batch.done += 1
+				if not entry.batches and not entry.standalone:
+					entry.key[-1] = None
+					del self._entries[key]
+			self.cond.notify_all()
+
+	def join(self):
+		with self.cond:
+			self.cond.wait_for(lambda: not self._entries)
+
+
+	def _pop(self) -> _Entry:
+		with self.cond:
+			while True:
+				while self._heap:
+					entry = heappop(self._heap)[-1]
+					if entry is not None:
+						entry.running = True
+						return entry
+				self.cond.wait()
+
+	def _thread_loop(self):
+		while True:
+			entry = self._pop()
+			error = None
+			try:
+				entry.prov.download_image(entry.img, **entry.kwargs)
+			except Exception as e:
+				error = e
+				log(f'{type(self).__name__}: {type(e).__name__}: {e} ({entry.img.url})')
+			self._finish(entry, error)
+
+	def _finish(self, entry: _Entry, error: Optional[Exception]):
+		with self.cond:
+			now = perf_counter()
+			stats = self.stats
+			stats.done += 1
+			if stats.first_done is None:
+				stats.first_done = now - self._start	# type: ignore
+			if entry.priority < Priority.DEFAULT:
+				stats.prioritized_waits.append(now - entry.queued)
+			if entry.prov.to_date(entry.img.date).toordinal() == self._newest and stats.newest_done is None:
+				stats.newest_done = now - self._start	# type: ignore
+
+			del self._entries[id(entry.img)]
+			for batch in entry.batches:
+				batch.done += 1
+			if not self._entries:
+				self._start = None
+				self._newest = None
+			self.cond.notify_all()
+
+		for batch in entry.batches:
+			if batch.on_done:
+				batch.on_done(entry.prov, entry.img, error)
+
+
+_scheduler: Optional[DownloadScheduler] = None
+
+def get_scheduler(n_jobs: int = 8) -> DownloadScheduler:
+	"""The scheduler shared by all providers, started on first use.
+
+	It runs as many workers as the largest `n_jobs` asked for so far.
+	"""
+	global _scheduler
+	if _scheduler is None:
+		_scheduler = DownloadScheduler(n_jobs)
+	else:
+		_scheduler.add_workers(n_jobs)
+	return _scheduler
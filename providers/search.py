@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from .base import ImageBase, ProviderBase, log
+
+
+SEARCH_FIELDS = ('title', 'credit', 'explanation', 'copyright')
+# bm25 weight of each field, matches on titles count the most
+SEARCH_WEIGHTS = {'title': 4.0, 'credit': 1.0, 'explanation': 1.0, 'copyright': 2.0}
+
+_CHUNK = 500	# keep under the SQLite variables limit
+
+
+@dataclass
+class SearchResult:
+	provider: str
+	key: str	# f_name
+	title: Optional[str]
+	score: float
+
+
+def init_search():
+	from db import db, ImageKey, ImageSearch
+	db.create_tables([ImageKey, ImageSearch], safe=True)
+
+
+def _row_ids(provider: str, keys: list[str]) -> dict[str, int]:
+	from db import ImageKey
+
+	ids = {}
+	for i in range(0, len(keys), _CHUNK):
+		chunk = keys[i:i + _CHUNK]
+		query = ImageKey.select().where(
+			(ImageKey.provider == provider) & ImageKey.key.in_(chunk))
+		ids.update((k.key, k.id) for k in query)
+
+	for key in keys:
+		if key not in ids:
+			ids[key] = ImageKey.create(provider=provider, key=key).id
+	return ids
+
+
+def index_images(prov: ProviderBase, images: Iterable[ImageBase]):
+	"""Add or replace `images` on the search index."""
+	from db import db, ImageSearch
+
+	images = list(images)
+	if not images:
+		return
+	log(f"{prov.__class__.__name__}: Indexing {len(images)} images for search")
+	init_search()
+
+	with db.atomic():
+		ids = _row_ids(prov.SHORT_NAME, [img.f_name for img in images])
+		rows = []
+		for img in images:
+			fields = dict.fromkeys(SEARCH_FIELDS)
+			fields.update(prov.search_fields(img))
+			rows.append(dict(fields, rowid=ids[img.f_name], provider=prov.SHORT_NAME, key=img.f_name))
+		for i in range(0, len(rows), _CHUNK // 8):
+			ImageSearch.replace_many(rows[i:i + _CHUNK // 8]).execute()
+
+
+def remove_images(prov: ProviderBase):
+	"""Drop all the images of `prov` from the search index."""
+	from db import db, ImageKey, ImageSearch
+
+	log(f"{prov.__class__.__name__}: Removing its images from search")
+	init_search()
+	with db.atomic():
+		ids = ImageKey.select(ImageKey.id).where(ImageKey.provider == prov.SHORT_NAME)
+		ImageSearch.delete().where(ImageSearch.rowid.in_(ids)).execute()
+		ImageKey.delete().where(ImageKey.provider == prov.SHORT_NAME).execute()
+
+
+def search(query: str, limit: int = 20, providers: Optional[Iterable[str]] = None) -> list[SearchResult]:
+	"""Ranked full text search, best matches first."""
+	from db import ImageSearch
+
+	init_search()
+	q = ImageSearch.search_bm25(
+		ImageSearch.clean_query(query, ' '),
+		weights=SEARCH_WEIGHTS,
+		with_score=True,
+		score_alias='score',
+	)
+	if providers is not None:
+		q = q.where(ImageSearch.provider.in_(list(providers)))
+	return [
+		# bm25 is negative, the lower the better
+		SearchResult(r.provider, r.key, r.title, -r.score)
+		for r in q.limit(limit)
+	]
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from hashlib import sha256
+from io import BytesIO
+from threading import Event, Thread
+from time import perf_counter, sleep
+from typing import Optional
+import shutil
+
+from PIL import Image
+import yaml
+
+from .base import CACHE_DIR, ImageBase, ProviderBase, log
+from .scheduler import SchedulerStats
+
+
+##### SYNTHETIC PROVIDER #####
+
+class StressProvider(ProviderBase):
+	"""Provider with a made up catalog and images, no network involved.
+
+	`update` adds the next `batch` entries of the catalog, like parsing a
+	page of upstream would, and `_fetch` makes a small PNG per url.
+	"""
+	SHORT_NAME = '_stress'
+
+	DATA_DIR = CACHE_DIR / SHORT_NAME
+	IMG_DIR = DATA_DIR / 'imgs'
+	COMPACT_DIR = DATA_DIR / 'compact'
+	RAW_DIR = DATA_DIR / 'raw'
+	DATA_FILE = DATA_DIR / f'{SHORT_NAME}.yaml'
+
+	START = date(2000, 1, 1)
+
+	def __init__(self, initlist=None, batch: int = 50, latency: float = 0.):
+		super().__init__(initlist)
+		self.batch = batch
+		self.latency = latency	# seconds per fetch, as the network would take
+
+	def entry(self, i: int) -> ImageBase:
+		return ImageBase(self.START + timedelta(days=i), f'stress://{i}', f'{i:06}.png')
+
+	def update(self, start: int = 0, on_progress=None, cancel: Optional[Event] = None) -> list[ImageBase]:
+		imgs = [self.entry(i) for i in range(start, start + self.batch)]
+		with self.lock:
+			known = {img.f_name for img in self.data}
+			new = [img for img in imgs if img.f_name not in known]
+			self.data += new
+		return new
+
+	def _fetch(self, url: str, params: Optional[dict] = None) -> bytes:
+		if self.latency:
+			sleep(self.latency)
+		i = int(url.rpartition('/')[2])
+		image = Image.new('RGB', (16, 16), (i % 256, i // 256 % 256, 128))
+		f = BytesIO()
+		image.save(f, format='PNG')
+		return f.getvalue()
+
+
+##### STRESS RUN #####
+
+@dataclass
+class StressReport:
+	images: int
+	dumps: int = 0
+	elapsed: float = 0.
+	errors: list[str] = field(default_factory=list)
+
+	def summary(self) -> str:
+		status = 'OK' if not self.errors else f'{len(self.errors)} ERRORS'
+		return (f'{status}: {self.images} images and {self.images} APOD pages, '
+			f'{self.dumps} dumps checked while parsing and downloading, in {self.elapsed:.2f}s')
+
+
+def _check_dumped(prov: StressProvider, report: StressReport):
+	with prov.DATA_FILE.open() as f:
+		data = yaml.unsafe_load(f)
+	f_names = [img.f_name for img in data]
+	if len(f_names) != len(set(f_names)):
+		report.errors.append(f'dump {report.dumps}: duplicated entries')
+	for img in data:
+		# All the file fields are set together, a dump never sees half of them
+		if (img.local is None) != (img.hash is None) or (img.local is None) != (img.size is None):
+			report.errors.append(f'dump {report.dumps}: {img.f_name} half updated')
+	report.dumps += 1
+
+def _check_apod_dumped(prov, report: StressReport):
+	from .apod import ApodStatus
+
+	with prov.DATA_FILE.open() as f:
+		data = yaml.unsafe_load(f)
+	with prov.STATUS_FILE.open() as f:
+		page_status = yaml.unsafe_load(f)
+	with prov.GROUPS_FILE.open() as f:
+		groups = yaml.unsafe_load(f)
+
+	url_paths = [img.url_path for img in data]
+	if len(url_paths) != len(set(url_paths)):
+		report.errors.append(f'apod dump {report.dumps}: duplicated url_path')
+	ok = {page for page, status in page_status.items() if status == ApodStatus.OK}
+	if ok != {img.page_name for img in data}:
+		report.errors.append(f'apod dump {report.dumps}: OK pages not matching the data')
+	grouped = [(name, page) for name, pages in groups.items() for page in pages]
+	if sorted(grouped) != sorted((status.name, page) for page, status in page_status.items()):
+		report.errors.append(f'apod dump {report.dumps}: groups not matching the status')
+	report.dumps += 1
+
+def _run_concurrently(produce, offsets: list[int], persist, check):
+	"""Run `produce(offset)` on a thread per offset, while `persist` and `check` run non stop."""
+	errors = []
+	stop = Event()
+	def dump():
+		while not stop.is_set():
+			persist()
+			try:
+				check()
+			except Exception as e:
+				errors.append(f'{type(e).__name__}: {e}')
+
+	producers = [
+		Thread(name=f'Stress Producer {i}', target=produce, args=(offset,))
+		for i, offset in enumerate(offsets)
+	]
+	dumper = Thread(name='Stress Dumper', target=dump)
+	for thread in (dumper, *producers):
+		thread.start()
+	for thread in producers:
+		thread.join()
+	return stop, dumper, errors
+
+def run_stress(n_images: int = 2000, batch: int = 50, n_producers: int = 2,
+			n_jobs: int = 8, keep: bool = False) -> StressReport:
+	"""Parse, download and dump synthetic catalogs all at the same time.
+
+	Producers add the catalog in batches (overlapping, so some entries are
+	added twice and must be deduplicated) and queue the new images on the
+	shared scheduler, while another thread dumps and reads back the catalog
+	non stop. Then the catalog, the files and the last dump must all agree.
+
+	Then the same goes for APOD, with producers running process_pages on
+	overlapping day pages: every dump must have the same pages OK on the
+	status as on the data, the groups matching the status, and no image
+	twice.
+	"""
+	report = StressReport(n_images)
+	t = perf_counter()
+	_stress_downloads(report, batch, n_producers, n_jobs, keep)
+	_stress_apod(report, batch, n_producers, keep)
+	report.elapsed = perf_counter() - t
+	for error in report.errors:
+		log(f'\t\tERROR {error}')
+	return report
+
+def _stress_downloads(report: StressReport, batch: int, n_producers: int, n_jobs: int, keep: bool):
+	from .scheduler import get_scheduler
+
+	n_images = report.images
+	prov = StressProvider(batch=batch)
+	shutil.rmtree(prov.DATA_DIR, ignore_errors=True)
+	prov.IMG_DIR.mkdir(parents=True)
+	scheduler = get_scheduler(n_jobs)
+	downloads = scheduler.batch()
+
+	def produce(offset: int):
+		for start in range(offset, n_images, batch):
+			new = prov.update(start)
+			scheduler.put_many(prov, new, downloads)
+
+	# Producers start half a batch apart, so each batch overlaps two others
+	offsets = [i * batch // n_producers for i in range(n_producers)]
+	stop, dumper, errors = _run_concurrently(produce, offsets, prov.dump, lambda: _check_dumped(prov, report))
+	downloads.wait()
+	stop.set()
+	dumper.join()
+	report.errors += errors
+	prov.dump()
+
+	# The last, partial, batch may add a few more than asked for
+	f_names = [img.f_name for img in prov]
+	if len(f_names) != len(set(f_names)):
+		report.errors.append('duplicated entries')
+	missing = {prov.entry(i).f_name for i in range(n_images)} - set(f_names)
+	if missing:
+		report.errors.append(f'{len(missing)} entries lost, eg: {min(missing)}')
+
+	for img in prov:
+		f_path = img.file
+		if not f_path or not f_path.is_file():
+			report.errors.append(f'{img.f_name}: not downloaded')
+			continue
+		data = f_path.read_bytes()
+		if img.size != len(data) or img.hash != sha256(data).hexdigest():
+			report.errors.append(f'{img.f_name}: size or hash not matching the file')
+
+	loaded = StressProvider()
+	loaded.load()
+	fields = lambda img: (img.f_name, img.local, img.size, img.hash)
+	if sorted(map(fields, loaded)) != sorted(map(fields, prov)):
+		report.errors.append('last dump not matching the catalog')
+
+	if not keep:
+		shutil.rmtree(prov.DATA_DIR)
+
+def _stress_apod(report: StressReport, batch: int, n_producers: int, keep: bool):
+	from .scaling import _synthetic_apod
+
+	n_pages = report.images
+	prov = _synthetic_apod()
+	shutil.rmtree(prov.DATA_DIR, ignore_errors=True)
+	prov.DATA_DIR.mkdir(parents=True)
+	pages = prov.page_names(0, n_pages)
+
+	def produce(offset: int):
+		for start in range(offset, n_pages, batch):
+			prov.process_pages(pages[start:start + batch], reset=False)
+
+	offsets = [i * batch // n_producers for i in range(n_producers)]
+	stop, dumper, errors = _run_concurrently(produce, offsets, prov.dump, lambda: _check_apod_dumped(prov, report))
+	stop.set()
+	dumper.join()
+	report.errors += [f'apod {e}' for e in errors]
+	prov.dump()
+	_check_apod_dumped(prov, report)
+
+	# Every synthetic page has its own image
+	missing = set(pages) - {img.page_name for img in prov}
+	if missing:
+		report.errors.append(f'apod: {len(missing)} pages lost, eg: {min(missing)}')
+
+	prov.clear_search()
+	if not keep:
+		shutil.rmtree(prov.DATA_DIR)
+
+
+##### SCHEDULER POLICIES #####
+
+@dataclass
+class PolicyResult:
+	policy: str
+	stats: SchedulerStats
+	elapsed: float
+
+def compare_policies(n_images: int = 500, n_jobs: int = 4, latency: float = 0.02,
+			request_after: float = 0.2) -> list[PolicyResult]:
+	"""Download a synthetic catalog with each scheduler policy, to compare them.
+
+	The catalog is queued oldest first, as stored, and after
+	`request_after` seconds an old image is requested, like a click on a
+	placeholder. The useful images are that one and the newest.
+	"""
+	from .scheduler import DownloadScheduler, Priority
+
+	results = []
+	for policy in ('fifo', 'priority'):
+		prov = StressProvider(latency=latency)
+		shutil.rmtree(prov.DATA_DIR, ignore_errors=True)
+		prov.IMG_DIR.mkdir(parents=True)
+		prov.data = [prov.entry(i) for i in range(n_images)]
+
+		scheduler = DownloadScheduler(n_jobs, policy)
+		t = perf_counter()
+		batch = scheduler.put_many(prov, prov.data)
+		sleep(request_after)
+		scheduler.put(prov, prov.data[n_images // 4], Priority.REQUESTED)
+		batch.wait()
+		scheduler.join()
+		results.append(PolicyResult(policy, scheduler.stats, perf_counter() - t))
+		shutil.rmtree(prov.DATA_DIR)
+	return results
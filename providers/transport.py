@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import requests
+
+from .archive import RawArchive
+from .base import CACHE_DIR, log
+
+
+MODES = ('passthrough', 'record', 'replay')
+STORE_DIR = CACHE_DIR / 'transport'
+
+
+class ReplayMiss(LookupError):
+	"""A request not recorded, in replay mode."""
+
+
+class Transport:
+	"""How providers get everything from upstream: pages, infos and images.
+
+	`passthrough` just does the request. `record` does it too, and keeps
+	the response on a RawArchive keyed by the full url. `replay` never
+	touches the network, it serves the recorded responses (as of `at`, if
+	given, else the latest) and raises ReplayMiss for anything else, so a
+	replayed run is offline and deterministic.
+	"""
+
+	def __init__(self, mode: str = 'passthrough', store_dir: Path = STORE_DIR, at: Optional[datetime] = None):
+		assert mode in MODES, f'Unknown transport mode: {mode}'
+		self.mode = mode
+		self.at = at
+		# Images are already compressed, so only text gets compressed
+		self.store = RawArchive(store_dir, compress=False)
+		self.requests = 0
+		self.misses = 0
+
+	@staticmethod
+	def request_name(url: str, params: Optional[dict] = None) -> str:
+		return requests.Request('GET', url, params=params).prepare().url	# type: ignore
+
+	def get(self, url: str, params: Optional[dict] = None) -> bytes:
+		name = self.request_name(url, params)
+		if self.mode == 'replay':
+			return self._replay(name)
+
+		self.requests += 1
+		res = requests.get(url, params=params)
+		assert res.status_code == 200, f'HTTP {res.status_code}: {name}'
+		if self.mode == 'record':
+			content_type = res.headers.get('Content-Type', '')
+			self.store.put(name, res.content, compress=not content_type.startswith('image/'))
+		return res.content
+
+	def _replay(self, name: str) -> bytes:
+		snapshot = self.store.at(name, self.at) if self.at else self.store.latest(name)
+		if snapshot is None:
+			self.misses += 1
+			raise ReplayMiss(f'Not recorded: {name}')
+		return self.store.read(snapshot)
+
+
+_transport: Optional[Transport] = None
+
+def get_transport() -> Transport:
+	"""The transport used by all providers, passthrough unless set."""
+	global _transport
+	if _transport is None:
+		_transport = Transport()
+	return _transport
+
+def set_transport(transport: Transport):
+	global _transport
+	log(f"{type(transport).__name__}: Using {transport.mode} mode (store={transport.store.root})")
+	_transport = transport
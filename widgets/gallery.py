@@ -1,27 +1,324 @@
 #!/usr/bin/env python3
 
 from __future__ import annotations
+from threading import Event, Thread
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk	# type: ignore
+from gi.repository import Gtk, GLib, Gio, GObject	# type: ignore
+from gi.repository.GdkPixbuf import Pixbuf	# type: ignore
+import numpy as np
 
 from widgets.gallery_card import ImageCardWidget
-from providers.bing import BingProvider, BingImage
+from providers.base import ImageBase, ProviderBase, ThreadWorkerPoll, log
+from providers.bing import BingProvider
+from providers.apod import ApodProvider
+from providers.index import CatalogIndex
+from providers.features import FeatureStore
+from providers.quota import QuotaManager
+from providers.scheduler import Priority, get_scheduler
 
 
+class RowItem(GObject.Object):
+	"""A row of the catalog index, as an item of the gallery model."""
+	def __init__(self, row: int):
+		super().__init__()
+		self.row = row
+
 
 class GalleryWidget(Gtk.FlowBox):
+	"""Cards for the images of all providers.
+
+	Nothing slow runs on the main loop: catalogs are loaded, thumbnails
+	decoded and providers synced on other threads, and the results get
+	back to the widgets through GLib.idle_add. Images not downloaded yet
+	get a placeholder card, and the ones on screen jump the download queue.
+
+	The cards are bound to a list of index rows, already filtered and
+	sorted by the index, so only the rows in the view get a widget and
+	the FlowBox never calls back into Python to filter or sort.
+	"""
+	VIEW_REFRESH_MS = 250
+	VISIBLE_REFRESH_MS = 150
+	TOUCH_DUMP_MS = 5000
+	CARDS_PER_IDLE = 200
 
 	def __init__(self):
 		super().__init__()
 
-		self.prov = BingProvider()
-		self.prov.load()
-	
+		self.index = CatalogIndex()
+		self.index.add_listener(self.on_index_update)
+		self.features = FeatureStore()
+		self.cards: dict[int, ImageCardWidget] = {}	# row -> card, in the view
+		self.thumbnails: dict[int, Pixbuf] = {}
+		self.thumbnailer = ThreadWorkerPoll(self._load_thumbnail, 2)
+
+		self.vadjustment = None
+		self.visible_rows: set[int] = set()
+		self._visible_refresh = None
+
+		self.criteria = {}
+		self.sort_key = 'date'
+		self.reverse = True
+		self.store = Gio.ListStore.new(RowItem)
+		self._view_rows = np.zeros(0, np.int64)	# rows to show, in order
+		self._shown = np.zeros(0, np.int64)		# rows on the store
+		self._view_refresh = None
+		self._view_splice = None
+
+		self.sync_cancel = Event()
+		self.syncing = False
+
+		self._touched: dict[int, ProviderBase] = {}	# id -> provider to dump
+		self._touch_dump = None
+		# Downloads asked for with a click, never cancelled
+		self.requests = get_scheduler().batch(on_done=self._on_requested)
+
 		self.init_ui()
+		Thread(name='Gallery Loader', target=self._load_providers, daemon=True).start()
 
 	def init_ui(self):
-		for entry in self.prov:
-			card = ImageCardWidget(entry.date, entry.file)
-			self.add(card)
\ No newline at end of file
+		self.bind_model(self.store, self._create_card)
+
+	def _load_providers(self):
+		self.features = FeatureStore.load()
+		for prov in (BingProvider(), ApodProvider()):
+			if prov.DATA_FILE.is_file():
+				prov.load()
+			self.index.add_provider(prov)
+			self.features.attach(prov)
+			GLib.idle_add(self._schedule_view_refresh)
+			for row in self.index.filter(local=True, providers=[prov.SHORT_NAME]):
+				self.thumbnailer.put(row)
+
+
+	##### CARDS #####
+
+	def on_index_update(self, row: int, new: bool):
+		# Called from worker threads
+		_, entry = self.index[row]
+		if new:
+			GLib.idle_add(self._schedule_view_refresh)
+		if entry.local:
+			self.thumbnailer.put(row)
+
+	def _create_card(self, item: RowItem) -> ImageCardWidget:
+		_, entry = self.index[item.row]
+		card = ImageCardWidget(entry.date, self.thumbnails.get(item.row))
+		card.row = item.row
+		card.connect('clicked', self.on_card_clicked)
+		card.connect('destroy', self._on_card_destroy)
+		self.cards[item.row] = card
+		card.show_all()
+		return card
+
+	def _on_card_destroy(self, card: ImageCardWidget):
+		# Out of the view, the thumbnail stays for when it's back
+		if self.cards.get(card.row) is card:
+			del self.cards[card.row]
+
+	def _load_thumbnail(self, row: int):
+		_, entry = self.index[row]
+		f_path = entry.file
+		if not f_path:
+			return
+		try:
+			thumbnail = ImageCardWidget.load_thumbnail(f_path)
+		except (GLib.Error, OSError) as e:
+			log(f'{type(self).__name__}: Error loading thumbnail ({f_path=}): {e}')
+			return
+		GLib.idle_add(self.set_thumbnail, row, thumbnail)
+
+	def set_thumbnail(self, row: int, thumbnail: Pixbuf):
+		self.thumbnails[row] = thumbnail
+		card = self.cards.get(row)
+		if card:
+			card.set_thumbnail(thumbnail)
+		return False
+
+	def on_card_clicked(self, card: ImageCardWidget):
+		prov, entry = self.index[card.row]
+		if entry.local:
+			prov.touch(entry)
+			self._schedule_touch_dump(prov)
+		else:
+			get_scheduler().put(prov, entry, Priority.REQUESTED, self.requests)
+
+	def _on_requested(self, prov: ProviderBase, img: ImageBase, error):
+		# Called from the scheduler workers. Out of a sync, nothing else
+		# would dump the downloaded file info, so it goes with the touches.
+		if error is None:
+			GLib.idle_add(self._schedule_touch_dump, prov)
+
+
+	def _schedule_touch_dump(self, prov: ProviderBase):
+		# Access times feed the quota LRU, so they're persisted, but a
+		# dump per click would be too much: they're coalesced.
+		self._touched[id(prov)] = prov
+		if self._touch_dump is None:
+			self._touch_dump = GLib.timeout_add(self.TOUCH_DUMP_MS, self._on_touch_dump)
+
+	def _on_touch_dump(self):
+		self._touch_dump = None
+		providers = list(self._touched.values())
+		self._touched.clear()
+		Thread(name='Gallery Dump', target=self._dump, args=(providers,), daemon=True).start()
+		return False
+
+	def _dump(self, providers: list[ProviderBase]):
+		for prov in providers:
+			try:
+				prov.dump()
+			except Exception as e:
+				log(f'{type(self).__name__}: Error dumping {prov.SHORT_NAME}: {type(e).__name__}: {e}')
+
+	def flush(self):
+		"""Dump the pending access times and features right away, eg: on exit."""
+		if self._touch_dump is not None:
+			GLib.source_remove(self._touch_dump)
+			self._touch_dump = None
+		providers = list(self._touched.values())
+		self._touched.clear()
+		self._dump(providers)
+		# Features of the images downloaded since the last sync
+		try:
+			self.features.save()
+		except Exception as e:
+			log(f'{type(self).__name__}: Error saving features: {type(e).__name__}: {e}')
+
+
+	##### VISIBILITY #####
+
+	def watch_scroll(self, vadjustment: Gtk.Adjustment):
+		self.vadjustment = vadjustment
+		vadjustment.connect('value-changed', lambda *_: self._schedule_visible_refresh())
+		vadjustment.connect('changed', lambda *_: self._schedule_visible_refresh())
+
+	def _schedule_visible_refresh(self):
+		if self._visible_refresh is None:
+			self._visible_refresh = GLib.timeout_add(self.VISIBLE_REFRESH_MS, self._on_visible_refresh)
+
+	def _on_visible_refresh(self):
+		self._visible_refresh = None
+		self.update_visible()
+		return False
+
+	def update_visible(self):
+		"""Raise the download priority of the cards on screen.
+
+		Cards leaving the screen go back to the default priority, they stay
+		queued. The viewport is sampled with get_child_at_pos, so it costs
+		the same whatever the number of cards.
+		"""
+		if self.vadjustment is None:
+			return
+		top = int(self.vadjustment.get_value())
+		bottom = top + int(self.vadjustment.get_page_size())
+		width = self.get_allocated_width()
+		step = ImageCardWidget.CARD_WIDTH // 3
+
+		visible = set()
+		for y in range(top, bottom, step):
+			for x in range(0, width, step):
+				child = self.get_child_at_pos(x, y)
+				if child:
+					visible.add(child.get_child().row)
+
+		scheduler = get_scheduler()
+		for row in self.visible_rows - visible:
+			scheduler.prioritize(self.index[row][1], Priority.DEFAULT)
+		for row in visible - self.visible_rows:
+			scheduler.prioritize(self.index[row][1], Priority.VISIBLE)
+		self.visible_rows = visible
+
+
+	##### VIEW #####
+
+	def set_view(self, sort_key: str = 'date', reverse: bool = True, **criteria):
+		"""Show only the images matching `criteria` (see CatalogIndex.filter)."""
+		self.sort_key = sort_key
+		self.reverse = reverse
+		self.criteria = criteria
+		self.refresh_view()
+
+	def refresh_view(self):
+		rows = self.index.filter(**self.criteria)
+		self._view_rows = np.asarray(self.index.sort(rows, self.sort_key, self.reverse), np.int64)
+		if self._view_splice is None:
+			self._view_splice = GLib.idle_add(self._splice_view)
+
+	def _schedule_view_refresh(self):
+		# Cards arrive one by one, so refreshes are coalesced
+		if self._view_refresh is None:
+			self._view_refresh = GLib.timeout_add(self.VIEW_REFRESH_MS, self._on_view_refresh)
+
+	def _on_view_refresh(self):
+		self._view_refresh = None
+		self.refresh_view()
+		return False
+
+	def _splice_view(self):
+		"""Bring the store a step closer to the view rows.
+
+		Only what changed between the common head and tail of both is
+		replaced, so new rows or a narrower filter don't rebuild every
+		card. Thousands of widgets at once would freeze the UI, so at most
+		CARDS_PER_IDLE rows are added per step.
+		"""
+		shown, target = self._shown, self._view_rows
+		n = min(len(shown), len(target))
+		diff = np.flatnonzero(shown[:n] != target[:n])
+		start = int(diff[0]) if len(diff) else n
+		end = 0		# length of the common tail
+		if n - start:
+			tail = n - start
+			diff = np.flatnonzero(shown[len(shown) - tail:][::-1] != target[len(target) - tail:][::-1])
+			end = int(diff[0]) if len(diff) else tail
+
+		added = target[start:len(target) - end]
+		chunk = added[:self.CARDS_PER_IDLE]
+		self.store.splice(start, len(shown) - start - end, [RowItem(int(row)) for row in chunk])
+		self._shown = np.concatenate([shown[:start], chunk, shown[len(shown) - end:]])
+		self._schedule_visible_refresh()
+
+		if len(chunk) < len(added):
+			return True
+		self._view_splice = None
+		return False
+
+
+	##### SYNC #####
+
+	def sync(self, on_progress, on_done):
+		"""Sync all the providers on a background thread.
+
+		`on_progress(provider, done, total)` and `on_done()` are called
+		on the main loop.
+		"""
+		if self.syncing:
+			return
+		self.syncing = True
+		self.sync_cancel.clear()
+		Thread(name='Gallery Sync', target=self._sync, args=(on_progress, on_done), daemon=True).start()
+
+	def cancel_sync(self):
+		self.sync_cancel.set()
+
+	def _sync(self, on_progress, on_done):
+		try:
+			providers = list(self.index.providers)
+			# Shared, so the total quota caps all the providers together
+			quota = QuotaManager.configured(providers)
+			for prov in providers:
+				if self.sync_cancel.is_set():
+					break
+				def progress(done, total, prov=prov):
+					GLib.idle_add(on_progress, prov, done, total)
+				try:
+					prov.sync(on_progress=progress, cancel=self.sync_cancel, quota=quota)
+				except Exception as e:
+					log(f'{type(self).__name__}: Error syncing {prov.SHORT_NAME}: {type(e).__name__}: {e}')
+		finally:
+			self.features.save()
+			self.syncing = False
+			GLib.idle_add(on_done)
@@ -1,36 +1,60 @@
 #!/usr/bin/env python3
 
 from __future__ import annotations
+from pathlib import Path
+from typing import Optional
 
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk	# type: ignore
-from gi.repository.GdkPixbuf import Pixbuf, InterpType	# type: ignore
+from gi.repository import Gtk, GLib	# type: ignore
+from gi.repository.GdkPixbuf import Colorspace, Pixbuf	# type: ignore
+from PIL import Image
 
+# Stock gdk-pixbuf has no WebP loader, as used by compacted images
+# (see providers.compact), so files it can't read are decoded with PIL
+_PIXBUF_EXTENSIONS = {
+	'.' + ext
+	for fmt in Pixbuf.get_formats()
+	for ext in fmt.get_extensions()
+}
 
 
 class ImageCardWidget(Gtk.Button):
 	CARD_WIDTH = 300
 
-	def __init__(self, date: str, f_path: Path):
+	def __init__(self, date: str, thumbnail: Optional[Pixbuf] = None):
 		super().__init__()
 		self.date = date
-		self.f_path = f_path
 	
 		self.init_ui()
+		if thumbnail:
+			self.set_thumbnail(thumbnail)
+
+	@classmethod
+	def load_thumbnail(cls, f_path: Path) -> Pixbuf:
+		# Decoding is the slow part, so it's done apart from the widget
+		# and can run outside the main loop.
+		if f_path.suffix.lower() in _PIXBUF_EXTENSIONS:
+			return Pixbuf.new_from_file_at_scale(str(f_path), cls.CARD_WIDTH, -1, True)
+
+		with Image.open(f_path) as image:
+			image.draft('RGB', (cls.CARD_WIDTH, cls.CARD_WIDTH))
+			image = image.convert('RGB')
+			w, h = image.size
+			size = (cls.CARD_WIDTH, max(1, round(h * cls.CARD_WIDTH / w)))
+			image = image.resize(size, Image.BILINEAR, reducing_gap=2.)
+		return Pixbuf.new_from_bytes(GLib.Bytes.new(image.tobytes()),
+			Colorspace.RGB, False, 8, *size, size[0] * 3)
 
 	def init_ui(self):
 		self.box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
 		self.add(self.box)
 
-		pb = Pixbuf.new_from_file(str(self.f_path))
-		o_w, o_h = pb.get_width(), pb.get_height()
-		ratio = self.CARD_WIDTH / o_w
-		n_h = o_h * ratio
-		spb = pb.scale_simple(self.CARD_WIDTH, n_h, InterpType.BILINEAR)
-		im = Gtk.Image.new_from_pixbuf(spb)
-		# im = Gtk.Image.new_from_file(str(self.f_path))
-		self.box.pack_start(im, False, False, 0)
+		self.image = Gtk.Image()
+		self.box.pack_start(self.image, False, False, 0)
 
 		label = Gtk.Label.new(f'Date: {self.date}')
 		self.box.pack_start(label, False, False, 0)
+
+	def set_thumbnail(self, thumbnail: Pixbuf):
+		self.image.set_from_pixbuf(thumbnail)
@@ -30,3 +30,24 @@ class MainHeaderBarWidget(Gtk.HeaderBar):
 		self.refresh_btn = Gtk.Button.new_from_icon_name('view-refresh', Gtk.IconSize.BUTTON)
 		self.pack_end(self.refresh_btn)
 
+		self.cancel_btn = Gtk.Button.new_from_icon_name('process-stop', Gtk.IconSize.BUTTON)
+		self.cancel_btn.set_no_show_all(True)
+		self.pack_end(self.cancel_btn)
+
+		self.progress = Gtk.ProgressBar(show_text=True, valign=Gtk.Align.CENTER)
+		self.progress.set_no_show_all(True)
+		self.pack_end(self.progress)
+
+	def set_syncing(self, syncing: bool):
+		self.refresh_btn.set_sensitive(not syncing)
+		self.cancel_btn.set_sensitive(True)
+		self.cancel_btn.set_visible(syncing)
+		self.progress.set_visible(syncing)
+		if syncing:
+			self.progress.set_fraction(0)
+			self.progress.set_text('Syncing')
+
+	def set_progress(self, name: str, done: int, total: int):
+		self.progress.set_fraction(done / total if total else 1)
+		self.progress.set_text(f'{name}: {done}/{total}')
+
@@ -18,13 +18,38 @@ class MainWindow(Gtk.Window):
 		kwargs['default_width'] = 900
 		kwargs['default_height'] = 500
 		super().__init__(*args, **kwargs)
-		self.connect("destroy", Gtk.main_quit)
+		self.connect("destroy", self.on_destroy)
 	
 		self.init_ui()
 
 	def init_ui(self):
-		hb = MainHeaderBarWidget()
-		gallery = GalleryWidget()
+		self.hb = MainHeaderBarWidget()
+		self.gallery = GalleryWidget()
 
-		self.set_titlebar(hb)
-		self.add(gallery)
\ No newline at end of file
+		self.hb.refresh_btn.connect('clicked', self.on_refresh)
+		self.hb.cancel_btn.connect('clicked', self.on_cancel)
+
+		scroll = Gtk.ScrolledWindow()
+		scroll.add(self.gallery)
+		self.gallery.watch_scroll(scroll.get_vadjustment())
+
+		self.set_titlebar(self.hb)
+		self.add(scroll)
+
+	def on_destroy(self, win: Gtk.Window):
+		self.gallery.flush()
+		Gtk.main_quit()
+
+	def on_refresh(self, btn: Gtk.Button):
+		self.hb.set_syncing(True)
+		self.gallery.sync(self.on_sync_progress, self.on_sync_done)
+
+	def on_cancel(self, btn: Gtk.Button):
+		btn.set_sensitive(False)
+		self.gallery.cancel_sync()
+
+	def on_sync_progress(self, prov, done: int, total: int):
+		self.hb.set_progress(prov.SHORT_NAME, done, total)
+
+	def on_sync_done(self):
+		self.hb.set_syncing(False)
\ No newline at end of file